@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import time
+from contextlib import closing
+from urllib.parse import parse_qs, urlsplit
+
+import grpc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube_dl_tiny_grpc import (Server)
+from youtube_dl_tiny_grpc.protobuf import youtube_dl_tiny_grpc_pb2_grpc
+from youtube_dl_tiny_grpc.protobuf import youtube_dl_tiny_grpc_pb2
+
+# Everything the stand-in extractor does is described by the url, eg:
+# http://bench.invalid/playlist/1?entries=10&latency=0.05&payload=2048
+_BENCH_URL = "http://bench.invalid"
+
+# Seconds between two samples of the memory used during a scenario
+_RSS_SAMPLE_INTERVAL = 0.05
+
+
+class FakeYoutubeDL(object):
+    """ Stand-in for YoutubeDL, extracting made up videos and playlists
+    after the latency given in their url. """
+
+    def __init__(self, opts: dict):
+        self.opts = opts
+
+    def extract_info(self, url: str, download: bool = True, ie_key: str = None) -> dict:
+        parts = urlsplit(url)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        kind, _, video_id = parts.path.strip('/').partition('/')
+        time.sleep(float(query.get('latency', 0)))
+
+        if kind != 'playlist':
+            return self._video(url, video_id, int(query.get('payload', 1024)))
+
+        entries = []
+        for i in range(int(query.get('entries', 10))):
+            entry_url = f"{_BENCH_URL}/video/{video_id}-{i}?{parts.query}"
+            if self.opts.get('extract_flat'):
+                entries.append({'_type': 'url', 'url': entry_url,
+                                'ie_key': 'Fake', 'id': f"{video_id}-{i}"})
+            else:
+                entries.append(self._video(entry_url, f"{video_id}-{i}",
+                                           int(query.get('payload', 1024))))
+        # Not the extractor of the videos, or their references would be
+        # taken for a nested playlist
+        return {'_type': 'playlist', 'id': video_id, 'extractor_key': 'FakePlaylist',
+                'webpage_url': url, 'entries': entries}
+
+    @staticmethod
+    def _video(url: str, video_id: str, payload: int) -> dict:
+        """A video whose formats add up to roughly payload bytes."""
+        format_url = f"https://media.bench.invalid/{video_id}?sig="
+        formats = [
+            {'format_id': str(i), 'ext': 'mp4', 'url': format_url + 'x' * 200}
+            for i in range(max(payload // 256, 1))
+        ]
+        return {'id': video_id, 'title': f"video {video_id}",
+                'extractor_key': 'Fake', 'webpage_url': url,
+                'formats': formats, 'requested_formats': formats[:2]}
+
+
+def _descendants(pid: int) -> list:
+    """Pids of the processes started by the given one, and by them in turn,
+    eg: the fork server and the pool workers."""
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        return []
+    return children + [grandchild for child in children for grandchild in _descendants(child)]
+
+
+def _rss(pid: int) -> int:
+    """Resident memory of the given process in bytes, 0 once it is gone."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+async def _sample_rss(peaks: dict) -> None:
+    """Keep track of the peak memory used by the server process alone, and
+    along with the processes it started, until cancelled."""
+    while True:
+        server = _rss(os.getpid())
+        total = server + sum(_rss(pid) for pid in _descendants(os.getpid()))
+        peaks['server'] = max(peaks.get('server', 0), server)
+        peaks['total'] = max(peaks.get('total', 0), total)
+        await asyncio.sleep(_RSS_SAMPLE_INTERVAL)
+
+
+def _percentile(values: list, percentile: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+
+async def _load(stub, requests: list, concurrency: int) -> dict:
+    """Send the requests with the given concurrency, returns the stats."""
+    latencies, first_messages, errors = [], [], 0
+    pending = iter(requests)
+
+    async def worker() -> None:
+        nonlocal errors
+        for request in pending:
+            start = time.monotonic()
+            first_message = None
+            try:
+                async for _ in stub.ExtractInfo(request):
+                    if first_message is None:
+                        first_message = time.monotonic() - start
+            except grpc.aio.AioRpcError:
+                errors += 1
+                continue
+            latencies.append(time.monotonic() - start)
+            first_messages.append(first_message or 0)
+
+    peaks = {}
+    sampler = asyncio.ensure_future(_sample_rss(peaks))
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        sampler.cancel()
+    duration = time.monotonic() - start
+
+    return {
+        'requests': len(requests),
+        'concurrency': concurrency,
+        'errors': errors,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'latency_p50_ms': round(_percentile(latencies, 50) * 1000, 2),
+        'latency_p99_ms': round(_percentile(latencies, 99) * 1000, 2),
+        'ttfm_p50_ms': round(_percentile(first_messages, 50) * 1000, 2),
+        'ttfm_p99_ms': round(_percentile(first_messages, 99) * 1000, 2),
+        # Sampled during this scenario only, the server process also
+        # running the benchmark clients
+        'server_peak_rss_bytes': peaks.get('server', 0),
+        'total_peak_rss_bytes': peaks.get('total', 0),
+    }
+
+
+def _request(path: str, args: argparse.Namespace, **kwargs):
+    return youtube_dl_tiny_grpc_pb2.ExtractInfoRequest(
+        url=f"{_BENCH_URL}/{path}?latency={args.latency}&payload={args.payload}"
+            f"&entries={args.playlist_size}",
+        **kwargs)
+
+
+async def run_benchmarks(port: int, args: argparse.Namespace) -> dict:
+    async with grpc.aio.insecure_channel(f"localhost:{port}") as channel:
+        stub = youtube_dl_tiny_grpc_pb2_grpc.YoutubeDLStub(channel)
+        # Unique per run, so nothing comes from a previous run's cache
+        run_id = int(time.time() * 1000)
+        n = args.requests
+        results = {}
+
+        results['cache-miss'] = await _load(
+            stub, [_request(f"video/{run_id}-miss-{i}", args) for i in range(n)],
+            args.concurrency)
+
+        hits = [_request(f"video/{run_id}-hit-{i}", args) for i in range(args.concurrency)]
+        await _load(stub, hits, args.concurrency)
+        results['cache-hit'] = await _load(
+            stub, [hits[i % len(hits)] for i in range(n)], args.concurrency)
+
+        playlists = max(n // args.playlist_size, 1)
+        results['playlist'] = await _load(
+            stub, [_request(f"playlist/{run_id}-{i}", args) for i in range(playlists)],
+            args.concurrency)
+        results['playlist-stream'] = await _load(
+            stub, [_request(f"playlist/{run_id}-stream-{i}", args, stream_entries=True)
+                   for i in range(playlists)],
+            args.concurrency)
+
+        return results
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the server against a stand-in extractor',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight at once')
+    parser.add_argument('--workers', type=int, default=4, help='Process pool workers')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds taken by every extraction')
+    parser.add_argument('--payload', type=int, default=4096, help='Approximate bytes per video')
+    parser.add_argument('--playlist-size', type=int, default=10, help='Videos per playlist')
+    parser.add_argument('--redis-uri', type=str, default=None,
+                        help='Redis to cache into, results are only cached in memory if not set')
+    return parser.parse_args(argv)
+
+
+def run(argv: list = None) -> dict:
+    args = parse_args(argv)
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.bind(('', 0))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        port = s.getsockname()[1]
+
+    server_args = {
+        "grpc_port": port,
+        "grpc_compression_algorithm": "none",
+        "youtube_dl_max_workers": args.workers,
+        "youtube_dl_max_queue": args.requests * 16,
+        "youtube_dl_class": FakeYoutubeDL,
+        "memory_cache_enable": True,
+        "memory_cache_max_bytes": 256 * 1024 * 1024,
+        "memory_cache_ttl": 3600,
+    }
+    if args.redis_uri:
+        server_args.update({"redis_enable": True, "redis_uri": args.redis_uri,
+                            "redis_ttl": 3600})
+
+    loop = asyncio.get_event_loop()
+    server = Server(server_args)
+    server_task = loop.create_task(server.run())
+    try:
+        results = loop.run_until_complete(run_benchmarks(port, args))
+    finally:
+        loop.run_until_complete(*server.cleanup)
+        server_task.cancel()
+
+    results['config'] = vars(args)
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level='WARNING')
+    run(sys.argv[1:])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import asyncio
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import ANY
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube_dl_tiny_grpc.cache import _DICTIONARY_KEY, MemoryCache, SqliteCache
+from youtube_dl_tiny_grpc.compression import Compression
+
+_HAS_ZSTD = importlib.util.find_spec('zstandard') is not None
+
+
+class SqliteCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.sqlite')
+        self.caches = []
+
+    async def asyncTearDown(self):
+        for cache in self.caches:
+            await cache.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open(self, max_bytes: int = 1024 * 1024, compression: Compression | None = None) -> SqliteCache:
+        cache = SqliteCache(self.path, 3600, max_bytes, compaction_interval=3600,
+                            compression=compression or Compression('none'))
+        self.caches.append(cache)
+        return cache
+
+    async def restart(self, cache: SqliteCache, **kwargs) -> SqliteCache:
+        """Close the cache once its writes are done and open it again."""
+        self.caches.remove(cache)
+        await cache.close()
+        return self.open(**kwargs)
+
+    async def test_persistence(self):
+        cache = self.open()
+        await cache.set('a', b'content of a', 600)
+        await cache.set('b', b'content of b')
+        cache = await self.restart(cache)
+
+        content, ttl = await cache.get_with_ttl('a')
+        self.assertEqual(content, b'content of a')
+        self.assertTrue(590 < ttl <= 600)
+        content, ttl = await cache.get_with_ttl('b')
+        self.assertEqual(content, b'content of b')
+        self.assertTrue(3590 < ttl <= 3600)
+        self.assertEqual(await cache.get('c'), None)
+        # Compressed entries, with their codec header
+        self.assertEqual(cache.size, 2 * len(b'\x00content of a'))
+
+    async def test_expiry(self):
+        cache = self.open()
+        await cache.set('a', b'short lived', 0.05)
+        await cache.set('b', b'long lived')
+        cache = await self.restart(cache)
+        await asyncio.sleep(0.1)
+        self.assertEqual(await cache.get('a'), None)
+
+        cache.size = await cache._query('compact', cache._compact)
+        self.assertEqual(cache.size, len(b'\x00long lived'))
+
+    async def test_eviction(self):
+        cache = self.open(max_bytes=5000)
+        # Never evicted, like the zstd dictionaries
+        await cache._send_if_absent('dictionary', b'd' * 2000)
+        for i in range(10):
+            await cache.set(f"entry-{i}", b'x' * 999, 100 * (i + 1))
+            await cache._writer
+
+        # Compacted as soon as it grows past max_bytes
+        await asyncio.wait_for(self.compacted(cache), 5)
+        # Again, in case the last write raced the compaction
+        cache.size = await cache._query('compact', cache._compact)
+        self.assertLessEqual(cache.size, 5000)
+        found = [i for i in range(10) if await cache.get(f"entry-{i}") is not None]
+        # The entries expiring last are kept, with their codec header
+        self.assertEqual(found, [7, 8, 9])
+        self.assertEqual(await cache._fetch(['dictionary']), [(b'd' * 2000, None)])
+
+        cache = await self.restart(cache, max_bytes=5000)
+        self.assertEqual(cache.size, 5000)
+
+    @staticmethod
+    async def compacted(cache: SqliteCache) -> None:
+        while cache.size > cache.max_bytes:
+            await asyncio.sleep(0.01)
+
+    @unittest.skipUnless(_HAS_ZSTD, "zstandard is not installed")
+    async def test_zstd_dictionary(self):
+        def payload(i: int) -> bytes:
+            return b'{"id": "%d", "formats": [%s]}' % (i, b', '.join(
+                b'{"format_id": "%d", "url": "https://media.bench.invalid/%d-%d"}' % (f, i, f)
+                for f in range(20)))
+
+        cache = self.open(compression=Compression('zstd', dictionary_size=1024))
+        codec = cache.compression.zstd()
+        i = 0
+        while codec.dictionary is None:
+            await cache.set(f"entry-{i}", payload(i))
+            await cache._writer
+            if cache._training is not None:
+                await cache._training
+            i += 1
+        await cache.set('after', payload(i))
+        cache = await self.restart(cache, compression=Compression('zstd'))
+
+        # Read with the dictionary stored along the entries
+        self.assertEqual(await cache.get('after'), payload(i))
+        self.assertEqual(await cache.get('entry-0'), payload(0))
+
+    @unittest.skipUnless(_HAS_ZSTD, "zstandard is not installed")
+    async def test_zstd_dictionary_race(self):
+        def payload(kind: bytes, i: int) -> bytes:
+            return b'{"%s": "%d", "formats": [%s]}' % (kind, i, b', '.join(
+                b'{"%s_id": "%d", "url": "https://%s.bench.invalid/%d-%d"}' % (kind, f, kind, i, f)
+                for f in range(20)))
+
+        async def train(cache: SqliteCache, kind: bytes) -> None:
+            i = 0
+            while cache._training is None or not cache._training.done():
+                await cache.set(f"{kind.decode()}-{i}", payload(kind, i))
+                await cache._writer
+                if cache._training is not None:
+                    await cache._training
+                i += 1
+
+        # Both started before either trained a dictionary
+        winner = self.open(compression=Compression('zstd', dictionary_size=1024))
+        loser = self.open(compression=Compression('zstd', dictionary_size=1024))
+        await winner.set('first', b'first')
+        await loser.set('first', b'first')
+        await asyncio.gather(winner._writer, loser._writer)
+
+        await train(winner, b'video')
+        await train(loser, b'channel')
+        won = winner.compression.zstd().dictionary.dict_id()
+        self.assertEqual(loser.compression.zstd().dictionary.dict_id(), won)
+        [lost] = set(loser.compression.zstd().dictionaries) - {won}
+        self.assertEqual(await loser._fetch([f"{_DICTIONARY_KEY}:{won}"]), [(ANY, None)])
+        # Not left behind for nothing
+        self.assertEqual(await loser._fetch([f"{_DICTIONARY_KEY}:{lost}"]), [(None, None)])
+
+
+class MemoryCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_eviction(self):
+        cache = MemoryCache(3000, 3600)
+        for i in range(4):
+            await cache.set(f"entry-{i}", b'x' * 1000)
+        await cache.get('entry-1')
+        await cache.set('entry-4', b'x' * 1000)
+        self.assertLessEqual(cache.size, 3000)
+        # Least recently used first
+        self.assertEqual([i for i in range(5) if await cache.get(f"entry-{i}")], [1, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import gzip
+import importlib.util
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube_dl_tiny_grpc.compression import CODECS, Compression, UnknownDictionary
+
+# Codecs depending on an optional package
+_MODULES = {'lz4': 'lz4', 'zstd': 'zstandard'}
+
+_HAS_ZSTD = importlib.util.find_spec('zstandard') is not None
+
+
+def _payload(i: int) -> bytes:
+    """A made up cached result, alike the others but for its ids."""
+    return b''.join(
+        b'{"format_id": "%d", "ext": "mp4", "url": "https://media.bench.invalid/%d-%d?sig=%s"}'
+        % (f, i, f, b'x' * (f % 7 + 20))
+        for f in range(12))
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for name in CODECS:
+            if name in _MODULES and importlib.util.find_spec(_MODULES[name]) is None:
+                continue
+            with self.subTest(codec=name):
+                compression = Compression(name)
+                compressed = compression.compress(_payload(0))
+                self.assertEqual(compressed[:1], CODECS[name].header)
+                self.assertEqual(compression.decompress(compressed), _payload(0))
+
+    def test_other_codec(self):
+        compressed = Compression('none').compress(_payload(0))
+        self.assertEqual(Compression('gzip').decompress(compressed), _payload(0))
+
+    def test_legacy_gzip(self):
+        # Written with no codec header by older versions
+        legacy = gzip.compress(_payload(0))
+        self.assertEqual(Compression('none').decompress(legacy), _payload(0))
+
+    def test_unknown_header(self):
+        with self.assertRaises(ValueError):
+            Compression().decompress(b'\x7f' + _payload(0))
+
+    @unittest.skipUnless(_HAS_ZSTD, "zstandard is not installed")
+    def test_zstd_dictionary(self):
+        writer = Compression('zstd', dictionary_size=1024)
+        codec = writer.zstd()
+        before = writer.compress(_payload(0))
+
+        trained = False
+        for i in range(1000):
+            if codec.sample(_payload(i)):
+                trained = True
+                break
+        self.assertTrue(trained)
+        dictionary = codec.train(codec.samples)
+        dict_id = codec.use_dictionary(dictionary)
+        self.assertEqual(codec.samples, [])
+        self.assertFalse(codec.sample(_payload(0)))
+
+        after = writer.compress(_payload(1))
+        self.assertEqual(codec.dictionary_id(after[1:]), dict_id)
+        self.assertLess(len(after), len(before))
+        self.assertEqual(writer.decompress(after), _payload(1))
+        self.assertEqual(writer.decompress(before), _payload(0))
+
+        # Another server only knows the dictionary once it loads it
+        reader = Compression('gzip')
+        self.assertEqual(reader.decompress(before), _payload(0))
+        with self.assertRaises(UnknownDictionary) as raised:
+            reader.decompress(after)
+        self.assertEqual(raised.exception.dict_id, dict_id)
+        reader.zstd().add_dictionary(dictionary)
+        self.assertEqual(reader.decompress(after), _payload(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube_dl_tiny_grpc.admission import Call, QueueFull
+from youtube_dl_tiny_grpc.limits import Limit, SiteLimiter, parse_limits
+
+
+class ParseLimitsTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_limits('YoutubeTab=2/5/3, vimeo.com=0.5, *=10/20'), {
+            'youtubetab': Limit(2, 5, 3),
+            'vimeo.com': Limit(0.5, 1, 0),
+            '*': Limit(10, 20, 0),
+        })
+        self.assertEqual(parse_limits(''), {})
+
+    def test_share(self):
+        # Divided between the servers, each still letting one through
+        self.assertEqual(parse_limits('a=4/6/3,b=1/1/1', share=4), {
+            'a': Limit(1, 1.5, 1),
+            'b': Limit(0.25, 1, 1),
+        })
+
+
+class SiteLimiterTest(unittest.IsolatedAsyncioTestCase):
+
+    def test_limit(self):
+        limiter = SiteLimiter(parse_limits('youtube:tab=1,vimeo.com=1,*=1'), 1)
+        self.assertEqual(limiter.limit(['YoutubeTab', 'youtube:tab'], 'www.youtube.com'),
+                         ('youtube:tab', 'youtube:tab'))
+        # Subdomains count against their parent domain
+        self.assertEqual(limiter.limit(['Vimeo'], 'player.vimeo.com'), ('vimeo.com', 'vimeo.com'))
+        self.assertEqual(limiter.limit(['Vimeo'], 'Vimeo.com'), ('vimeo.com', 'vimeo.com'))
+        # Every other site on its own, by extractor or else by host
+        self.assertEqual(limiter.limit(['Generic'], 'example.com'), ('*', 'Generic'))
+        self.assertEqual(limiter.limit([], 'example.com'), ('*', 'example.com'))
+        self.assertEqual(SiteLimiter(parse_limits('vimeo.com=1'), 1).limit(['Generic'], 'example.com'), None)
+
+    async def test_rate(self):
+        limiter = SiteLimiter(parse_limits('a=20/2'), 10)
+        start = time.monotonic()
+        times = []
+        for _ in range(4):
+            release = await limiter.acquire('a', 'a')
+            times.append(time.monotonic() - start)
+            release()
+        # The burst right away, then one every 1/rate seconds
+        self.assertLess(times[1], 0.04)
+        self.assertGreater(times[2], 0.04)
+        self.assertGreater(times[3], 0.09)
+        self.assertLess(times[3], 0.5)
+
+    async def test_sites_wait_on_their_own(self):
+        limiter = SiteLimiter(parse_limits('*=1/1'), 10)
+        (await limiter.acquire('*', 'a'))()
+        waiting = asyncio.ensure_future(limiter.acquire('*', 'a'))
+        release = await asyncio.wait_for(limiter.acquire('*', 'b'), 0.1)
+        release()
+        self.assertFalse(waiting.done())
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+
+    async def test_concurrency(self):
+        limiter = SiteLimiter(parse_limits('a=0/0/2'), 10)
+        first = await limiter.acquire('a', 'a')
+        second = await limiter.acquire('a', 'a')
+        third = asyncio.ensure_future(limiter.acquire('a', 'a'))
+        await asyncio.sleep(0.01)
+        self.assertFalse(third.done())
+
+        first()
+        release = await asyncio.wait_for(third, 1)
+        second()
+        release()
+        self.assertEqual(limiter._sites['a'].running, 0)
+
+    async def test_cancelled_waiter(self):
+        limiter = SiteLimiter(parse_limits('a=0/0/1'), 10)
+        release = await limiter.acquire('a', 'a')
+        cancelled = asyncio.ensure_future(limiter.acquire('a', 'a'))
+        waiting = asyncio.ensure_future(limiter.acquire('a', 'a'))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.sleep(0.01)
+
+        # Skipped rather than holding the slot
+        release()
+        (await asyncio.wait_for(waiting, 1))()
+        self.assertEqual(limiter._sites['a'].running, 0)
+
+    async def test_queue_full(self):
+        limiter = SiteLimiter(parse_limits('a=0/0/1'), 2)
+        release = await limiter.acquire('a', 'a')
+        call = Call(16)
+        call.admitted = True
+        waiting = [asyncio.ensure_future(limiter.acquire('a', 'a')) for _ in range(2)]
+        await asyncio.sleep(0.01)
+
+        with self.assertRaises(QueueFull):
+            await limiter.acquire('a', 'a')
+        with self.assertRaises(QueueFull):
+            await limiter.acquire('a', 'a', Call(16))
+        # Not cut short once its call was admitted
+        waiting.append(asyncio.ensure_future(limiter.acquire('a', 'a', call)))
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(limiter._sites['a'].waiters), 3)
+
+        release()
+        for future in waiting:
+            (await asyncio.wait_for(future, 1))()
+        self.assertEqual(limiter._sites['a'].running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube_dl_tiny_grpc.options import parse_opts
+
+
+class ParseOptsTest(unittest.TestCase):
+
+    def parse(self, argv: list):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return parse_opts(argv)
+
+    def test_cache(self):
+        self.assertTrue(self.parse(['--redis-enable']).redis_enable)
+        self.assertTrue(self.parse(['--sqlite-enable']).sqlite_enable)
+
+    def test_redis_and_sqlite(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr), self.assertRaises(SystemExit):
+            self.parse(['--redis-enable', '--sqlite-enable'])
+        self.assertIn("--redis-enable and --sqlite-enable cannot be used together", stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import os
+import signal
+import sys
+import time
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube_dl_tiny_grpc.util import RecyclingProcessPool
+
+
+class RecyclingProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = RecyclingProcessPool(max_workers=1)
+        for future in self.pool.warmed():
+            future.result(timeout=30)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_killed_worker(self):
+        pid = self.pool.submit(os.getpid).result(timeout=30)
+        running = self.pool.submit(time.sleep, 30)
+        os.kill(pid, signal.SIGKILL)
+        with self.assertRaises(BrokenProcessPool):
+            running.result(timeout=30)
+
+        # Replaced by a new pool rather than failing every task from now on
+        self.assertFalse(self.pool.broken())
+        self.assertNotEqual(self.pool.submit(os.getpid).result(timeout=30), pid)
+        self.assertEqual(self.pool.submit(pow, 2, 3).result(timeout=30), 8)
+
+    def test_killed_worker_on_submit(self):
+        pid = self.pool.submit(os.getpid).result(timeout=30)
+        os.kill(pid, signal.SIGKILL)
+        # Not replaced until a task is submitted
+        while not self.pool._pool._broken:
+            time.sleep(0.01)
+        self.assertEqual(self.pool.submit(pow, 2, 3).result(timeout=30), 8)
+
+    def test_broken_while_starting(self):
+        self.pool.shutdown()
+        self.pool = RecyclingProcessPool(max_workers=1, initializer=os._exit, initargs=(1,))
+        with self.assertRaises(BrokenProcessPool):
+            self.pool.warmed()[0].result(timeout=30)
+        self.assertTrue(self.pool.broken())
+        with self.assertRaises(BrokenProcessPool):
+            self.pool.submit(os.getpid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube_dl_tiny_grpc import youtube_dl_service
+from youtube_dl_tiny_grpc.cache import MemoryCache
+from youtube_dl_tiny_grpc.metrics import _REGISTRY
+from youtube_dl_tiny_grpc.protobuf.youtube_dl_tiny_grpc_pb2 import \
+    ExtractInfoRequest, ExtractInfoResponse, YoutubeDLOptions
+from youtube_dl_tiny_grpc.youtube_dl_service import ExtractInfoError, YoutubeDLServer, \
+    _NEXT_PAGE_TOKEN_KEY, _page_token, _parse_page_token
+
+from bench_youtube_dl_tiny_grpc import _BENCH_URL, FakeYoutubeDL
+
+
+class CountingYoutubeDL(FakeYoutubeDL):
+    """ Stand-in extractor keeping track of what it extracts, and only
+    extracting the entries of a playlist from playliststart to playlistend
+    like YoutubeDL. """
+
+    # (url path, whether the extraction was flat)
+    extracted = []
+
+    def extract_info(self, url: str, download: bool = True, ie_key: str = None) -> dict:
+        CountingYoutubeDL.extracted.append(
+            (url.split('?')[0][len(_BENCH_URL):], bool(self.opts.get('extract_flat'))))
+        info = super().extract_info(url, download, ie_key)
+        if 'entries' in info:
+            start, end = self.opts.get('playliststart', 1), self.opts.get('playlistend')
+            info['entries'] = info['entries'][start - 1:end]
+        return info
+
+
+class YoutubeDLServerTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        CountingYoutubeDL.extracted = []
+        youtube_dl_service.init_worker(0, CountingYoutubeDL)
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        youtube_dl_service.configure({}, self.pool, None, None,
+                                     MemoryCache(64 * 1024 * 1024, 3600))
+        self.servicer = YoutubeDLServer()
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    async def ids(self, url: str, trailers: list | None = None, **kwargs) -> list:
+        return [ExtractInfoResponse.FromString(response).id async for response in
+                self.servicer._responses(ExtractInfoRequest(url=url, **kwargs),
+                                         trailers=trailers)]
+
+    async def pages(self, url: str, **kwargs) -> list:
+        """Ids of every page of the given playlist, following the tokens
+        of the next pages."""
+        pages, token = [], ''
+        while True:
+            trailers = []
+            pages.append(await self.ids(url, trailers, page_token=token, **kwargs))
+            tokens = [value for key, value in trailers if key == _NEXT_PAGE_TOKEN_KEY]
+            if not tokens:
+                return pages
+            token, = tokens
+
+    async def test_video(self):
+        self.assertEqual(await self.ids(f"{_BENCH_URL}/video/v"), ['v'])
+        self.assertEqual(await self.ids(f"{_BENCH_URL}/video/v"), ['v'])
+        self.assertEqual(CountingYoutubeDL.extracted, [('/video/v', True)])
+
+    async def test_playlist_cached_entries(self):
+        for i in range(2):
+            await self.ids(f"{_BENCH_URL}/video/p-{i}?entries=3")
+        CountingYoutubeDL.extracted = []
+
+        for stream_entries in (False, True):
+            self.assertEqual(
+                sorted(await self.ids(f"{_BENCH_URL}/playlist/p?entries=3",
+                                      stream_entries=stream_entries)),
+                ['p-0', 'p-1', 'p-2'])
+        # Listed once, only the entry missing from the cache being
+        # extracted, then served from the cache
+        self.assertEqual(CountingYoutubeDL.extracted, [
+            ('/playlist/p', True),
+            ('/video/p-2', False),
+        ])
+
+    async def test_request_seconds(self):
+        def observed(outcome: str) -> float:
+            return _REGISTRY.get_sample_value('request_seconds_count', {'outcome': outcome}) or 0
+
+        before = {outcome: observed(outcome) for outcome in ('miss', 'hit', 'invalid_argument')}
+        await self.ids(f"{_BENCH_URL}/video/v")
+        await self.ids(f"{_BENCH_URL}/video/v")
+        with self.assertRaises(ExtractInfoError):
+            await self.ids(f"{_BENCH_URL}/video/v", page_token='garbage')
+        # Failed requests too
+        self.assertEqual({outcome: observed(outcome) - count for outcome, count in before.items()},
+                         {'miss': 1, 'hit': 1, 'invalid_argument': 1})
+
+    async def test_warm_live(self):
+        url = f"{_BENCH_URL}/playlist/w?entries=3"
+        _, ttl = await asyncio.gather(self.ids(url), self.servicer.warm(ExtractInfoRequest(url=url)))
+        # Extracted once for both
+        self.assertEqual(sorted(CountingYoutubeDL.extracted), [
+            ('/playlist/w', True),
+            ('/video/w-0', False), ('/video/w-1', False), ('/video/w-2', False),
+        ])
+        self.assertTrue(3500 < ttl <= 3600)
+
+    async def test_warm_cached(self):
+        url = f"{_BENCH_URL}/playlist/w?entries=3"
+        await self.ids(url)
+        CountingYoutubeDL.extracted = []
+        ttl = await self.servicer.warm(ExtractInfoRequest(url=url))
+        # Only listed again, the entries being cached for long
+        self.assertEqual(CountingYoutubeDL.extracted, [('/playlist/w', True)])
+        self.assertTrue(3500 < ttl <= 3600)
+
+        # Entries expiring within the lead are extracted again
+        CountingYoutubeDL.extracted = []
+        await self.servicer.warm(ExtractInfoRequest(url=url), 7200)
+        self.assertEqual(sorted(CountingYoutubeDL.extracted), [
+            ('/playlist/w', True),
+            ('/video/w-0', False), ('/video/w-1', False), ('/video/w-2', False),
+        ])
+
+    async def test_pages(self):
+        url = f"{_BENCH_URL}/playlist/p?entries=5"
+        self.assertEqual(await self.pages(url, page_size=2),
+                         [['p-0', 'p-1'], ['p-2', 'p-3'], ['p-4']])
+        # Listed up to the end of each page, twice as far as before at least
+        listings = [path for path, flat in CountingYoutubeDL.extracted if flat]
+        self.assertEqual(listings, ['/playlist/p'] * 3)
+
+        # Served from the cached listing
+        CountingYoutubeDL.extracted = []
+        self.assertEqual(await self.pages(url, page_size=3), [['p-0', 'p-1', 'p-2'], ['p-3', 'p-4']])
+        self.assertEqual(CountingYoutubeDL.extracted, [])
+
+    async def test_pages_of_video(self):
+        self.assertEqual(await self.pages(f"{_BENCH_URL}/video/v", page_size=5), [['v']])
+        self.assertEqual(await self.pages(f"{_BENCH_URL}/video/v", page_size=5), [['v']])
+        # Extracted once, while listed
+        self.assertEqual(CountingYoutubeDL.extracted, [('/video/v', True)])
+
+    async def test_pages_within_playlist_range(self):
+        url = f"{_BENCH_URL}/playlist/p?entries=10"
+        options = YoutubeDLOptions(playliststart=2, playlistend=4)
+        self.assertEqual(await self.pages(url, page_size=2, options=options),
+                         [['p-1', 'p-2'], ['p-3']])
+        self.assertEqual(await self.pages(url, page_size=5, options=options),
+                         [['p-1', 'p-2', 'p-3']])
+        # Past the end of the playlist
+        options = YoutubeDLOptions(playliststart=4, playlistend=20)
+        self.assertEqual(await self.pages(f"{_BENCH_URL}/playlist/p?entries=5", page_size=4,
+                                          options=options), [['p-3', 'p-4']])
+
+    async def test_invalid_page_token(self):
+        url = f"{_BENCH_URL}/playlist/p?entries=5"
+        for kwargs in ({'page_token': 'garbage', 'page_size': 2},
+                       {'page_token': _page_token('other', 3, 'p-1'), 'page_size': 2},
+                       {'page_token': _page_token('listing', 3, 'p-1')}):
+            with self.subTest(**kwargs):
+                with self.assertRaises(ExtractInfoError) as raised:
+                    await self.ids(url, [], **kwargs)
+                self.assertEqual(raised.exception.code, grpc.StatusCode.INVALID_ARGUMENT)
+
+
+class PageTokenTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        token = _page_token('0123456789abcdef0123', 3, 'p-1')
+        self.assertEqual(_parse_page_token(token, '0123456789abcdef0123'), (3, 'p-1'))
+
+    def test_invalid(self):
+        token = _page_token('0123456789abcdef0123', 3, 'p-1')
+        for token, key in ((token, 'another listing key'),
+                           (_page_token('key', 1, 'p-0'), 'key'),
+                           ('garbage', 'key'),
+                           ('', 'key')):
+            with self.subTest(token=token):
+                with self.assertRaises(ExtractInfoError) as raised:
+                    _parse_page_token(token, key)
+                self.assertEqual(raised.exception.code, grpc.StatusCode.INVALID_ARGUMENT)
+
+
+if __name__ == '__main__':
+    unittest.main()
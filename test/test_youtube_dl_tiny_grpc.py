@@ -44,6 +44,29 @@ TEST_MATRIX = [
             }),
         "expected_responses": 2
     },
+    {
+        "meta": "Youtube Playlist ID Streaming",
+        "message": ParseDict(
+            message=youtube_dl_tiny_grpc_pb2.ExtractInfoRequest(),
+            js_dict={
+                "url":            "https://www.youtube.com/playlist?list=PLbpi6ZahtOH7WFEYxB4kUB2QwsshALAwy",
+                "options":        {"playlistend": 3},
+                "stream_entries": True,
+                "keep_order":     True
+            }),
+        "expected_responses": 3
+    },
+    {
+        "meta": "Youtube Channel ID Field Mask",
+        "message": ParseDict(
+            message=youtube_dl_tiny_grpc_pb2.ExtractInfoRequest(),
+            js_dict={
+                "url":     "https://www.youtube.com/channel/UCZJbZ-0Dxdj5ETtJqcJQO2g",
+                "options": {"playlistend": 2},
+                "fields":  "requestedFormats.url"
+            }),
+        "expected_responses": 2
+    },
 ]
 
 
@@ -68,6 +91,28 @@ async def run_tests(port: int) -> None:
                 raise
 
 
+async def run_batch_tests(port: int) -> None:
+    async with grpc.aio.insecure_channel(f"localhost:{port}") as channel:
+        stub = youtube_dl_tiny_grpc_pb2_grpc.YoutubeDLStub(channel)
+        response_count = [0] * len(TEST_MATRIX)
+
+        async for response in stub.BatchExtractInfo(
+                youtube_dl_tiny_grpc_pb2.BatchExtractInfoRequest(
+                    requests=[test_case['message'] for test_case in TEST_MATRIX])):
+            assert response.code == 0, response.error
+            response_count[response.index] = response_count[response.index] + 1
+            response_dict = MessageToDict(response.response)
+            assert len(response_dict['requestedFormats']) > 0
+
+        for test_case, count in zip(TEST_MATRIX, response_count):
+            try:
+                assert count == test_case["expected_responses"]
+            except AssertionError:
+                print(
+                    f"{test_case['meta']} batch failed: {count} != {test_case['expected_responses']}")
+                raise
+
+
 def run():
     with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
         s.bind(('', 0))
@@ -76,6 +121,7 @@ def run():
         server = Server({"grpc_port": s.getsockname()[1]})
         server_task = loop.create_task(server.run())
         loop.run_until_complete(run_tests(s.getsockname()[1]))
+        loop.run_until_complete(run_batch_tests(s.getsockname()[1]))
         server_task.cancel()
         loop.stop()
 
@@ -6,6 +6,7 @@ import logging
 import asyncio
 import errno
 import os
+import signal
 
 from prometheus_client import multiprocess, start_http_server
 
@@ -18,6 +19,69 @@ _PROGNAME = 'youtube-dl-tiny-grpc'
 _LOG_FORMAT = '%(levelname)s - %(asctime)s - %(name)s - %(process)d - %(' \
               'message)s'
 
+log = logging.getLogger(__name__)
+
+
+def _serve(args) -> None:
+    """ Run a server until it is asked to stop. """
+    loop = asyncio.get_event_loop()
+    server = Server(args.__dict__)
+    try:
+        loop.run_until_complete(server.run())
+    except:  # noqa: E722
+        pass
+    finally:
+        loop.run_until_complete(*server.cleanup)
+        loop.stop()
+
+
+def _serve_forked(args) -> None:
+    """ Fork a server per --grpc-processes, all listening on the same port
+    and each with a slice of the youtube-dl workers. They are all stopped
+    as soon as one of them stops. """
+    pids = []
+    processes = args.grpc_processes
+    max_workers = args.youtube_dl_max_workers
+    for i in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            setproctitle(f"{_PROGNAME}: server {i}")
+            args.youtube_dl_max_workers = max(
+                max_workers // processes + (i < max_workers % processes), 1)
+            if i > 0:
+                # Warmed once for all, the cache being shared through redis
+                args.warmer_file = ""
+            code = 0
+            try:
+                _serve(args)
+            except BaseException:  # pylint: disable=broad-except
+                log.exception("server %s failed", i)
+                code = 1
+            finally:
+                os._exit(code)
+        pids.append(pid)
+
+    def stop(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    remaining = set(pids)
+    while remaining:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        remaining.discard(pid)
+        if args.prometheus_enable:
+            multiprocess.mark_process_dead(pid)
+        stop(None, None)
+
 
 def main(argv=None):
     setproctitle(_PROGNAME)
@@ -30,8 +94,6 @@ def main(argv=None):
     else:
         logging.basicConfig()
 
-    loop = asyncio.get_event_loop()
-
     if args.prometheus_enable:
         if port_is_in_use(args.prometheus_port):
             raise Exception(os.strerror(errno.EADDRINUSE))
@@ -44,14 +106,10 @@ def main(argv=None):
     if port_is_in_use(args.grpc_port):
         raise Exception(os.strerror(errno.EADDRINUSE))
 
-    server = Server(args.__dict__)
-    try:
-        loop.run_until_complete(server.run())
-    except:  # noqa: E722
-        pass
-    finally:
-        loop.run_until_complete(*server.cleanup)
-        loop.stop()
+    if args.grpc_processes > 1:
+        _serve_forked(args)
+    else:
+        _serve(args)
 
 
 __all__ = ['main']
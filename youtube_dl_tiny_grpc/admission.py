@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .metrics import _REGISTRY
+
+POOL_WORKERS = Gauge('pool_workers', 'Number of process pool workers by state', ['state'], multiprocess_mode='livesum', registry=_REGISTRY)
+QUEUE_DEPTH = Gauge('admission_queue_depth', 'Number of jobs waiting for a process pool worker', multiprocess_mode='livesum', registry=_REGISTRY)
+QUEUE_WAIT_SECONDS = Histogram('admission_queue_wait_seconds', 'Time spent by jobs waiting for a process pool worker', registry=_REGISTRY)
+REJECTED_TOTAL = Counter('admission_rejected_total', 'Total number of jobs rejected before reaching the process pool', ['reason'], registry=_REGISTRY)
+
+# Weight of the last job in the moving average of the job duration
+_EWMA_ALPHA = 0.2
+
+
+class QueueFull(Exception):
+    """ The admission queue is full. """
+
+
+class Call(object):
+    """ Jobs of a single gRPC call, admitted as a whole: the call is only
+    rejected while none of its jobs got a slot or a place in the queue, so
+    a playlist or a batch is not cut short halfway. Up to `window` of its
+    jobs wait or run at once, the others waiting for their turn in the
+    window rather than being rejected. """
+
+    def __init__(self, window: int):
+        self.window = asyncio.Semaphore(window)
+        self.admitted = False
+
+
+class AdmissionQueue(object):
+    """ Bounds the jobs sent to the process pool: up to `slots` jobs run at
+    once and up to `max_queue` jobs wait for a slot, anything else is
+    rejected, unless their call was already admitted. Waiting jobs get the
+    free slots in turns by site, in order within a site, so a burst for one
+    site does not starve the others.
+    Unlike the unbounded queue of the pool, a waiting job is dropped as soon
+    as its caller goes away. """
+
+    def __init__(self, slots: int, max_queue: int):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.running = 0
+        self._update_workers()
+        # Waiting jobs by site, the site next in turn first
+        self.waiters: dict[str, deque[asyncio.Future]] = {}
+        self.queued = 0
+        # Moving average of the job duration, in seconds
+        self.job_duration: float | None = None
+
+    def _update_workers(self) -> None:
+        POOL_WORKERS.labels('busy').set(self.running)
+        POOL_WORKERS.labels('idle').set(self.slots - self.running)
+
+    def idle(self) -> bool:
+        """ Whether a new job would get a slot right away. """
+        return self.running < self.slots and not self.queued
+
+    def expected_wait(self) -> float:
+        """ Estimated time a new job would wait for a slot, in seconds. """
+        if self.running < self.slots or self.job_duration is None:
+            return 0
+        return (self.queued + 1) / self.slots * self.job_duration
+
+    async def _acquire(self, site: str, call: Call | None) -> None:
+        """ Wait for a free slot. """
+        if self.running < self.slots and not self.queued:
+            self.running += 1
+            self._update_workers()
+            if call is not None:
+                call.admitted = True
+            return
+
+        if self.queued >= self.max_queue and (call is None or not call.admitted):
+            REJECTED_TOTAL.labels('queue_full').inc()
+            raise QueueFull("too many jobs waiting for a worker")
+        if call is not None:
+            call.admitted = True
+
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(site, deque()).append(future)
+        self.queued += 1
+        QUEUE_DEPTH.inc()
+        start = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over right before the cancellation
+                self._release()
+            elif future in self.waiters.get(site, ()):
+                self.waiters[site].remove(future)
+                self.queued -= 1
+                if not self.waiters[site]:
+                    del self.waiters[site]
+            REJECTED_TOTAL.labels('cancelled').inc()
+            raise
+        finally:
+            QUEUE_DEPTH.dec()
+            QUEUE_WAIT_SECONDS.observe(time.monotonic() - start)
+
+    def _release(self) -> None:
+        """ Hand the slot over to the next waiting job, if any, of the site
+        next in turn. """
+        while self.waiters:
+            site = next(iter(self.waiters))
+            queue = self.waiters.pop(site)
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                # Back of the line for the next slot
+                self.waiters[site] = queue
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+        self._update_workers()
+
+    def _done(self, start: float, job: asyncio.Future) -> None:
+        """ Release the slot of a finished job. """
+        self._release()
+        duration = time.monotonic() - start
+        if self.job_duration is None:
+            self.job_duration = duration
+        else:
+            self.job_duration += _EWMA_ALPHA * (duration - self.job_duration)
+        if not job.cancelled():
+            # Retrieved so it is not reported when nobody awaits the job
+            job.exception()
+
+    async def run(self, submit: Callable[[], Awaitable], site: str = '',
+                  call: Call | None = None) -> Any:
+        """ Wait for a slot and run the job submitted by the given callable,
+        for the given site and as part of the given call, if any. Once
+        submitted, the job keeps its slot until it is done, even if the
+        caller goes away, as the worker stays busy anyway. """
+        await self._acquire(site, call)
+        start = time.monotonic()
+        job = asyncio.ensure_future(submit())
+        job.add_done_callback(lambda _: self._done(start, job))
+        return await asyncio.shield(job)
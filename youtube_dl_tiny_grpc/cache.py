@@ -1,13 +1,44 @@
 from __future__ import annotations
 
 import asyncio
-import gzip
 import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
 from typing import Any
 
-from aioredis import from_url
+from aioredis import BlockingConnectionPool, Redis
 from aioredis.exceptions import ConnectionError
+from prometheus_client import Histogram
+
+from .compression import Compression, UnknownDictionary
+from .metrics import _REGISTRY
+
+REDIS_SECONDS = Histogram('redis_seconds', 'Time spent in redis round trips', ['operation'], registry=_REGISTRY)
+SQLITE_SECONDS = Histogram('sqlite_seconds', 'Time spent in sqlite queries', ['operation'], registry=_REGISTRY)
+
+# Upper bound of the time the cache is skipped after consecutive failures
+_MAX_CIRCUIT_BREAKER_BACKOFF = 60
+
+# Writes are dropped past this number of pending ones
+_MAX_PENDING_WRITES = 1024
+
+# Payloads from this size on are compressed and decompressed off the event
+# loop
+_OFF_LOOP_MIN_SIZE = 64 * 1024
+
+# Key of the zstd dictionary in use, each dictionary also being kept under
+# this key suffixed with its id for as long as payloads may refer to it
+_DICTIONARY_KEY = 'youtube_dl_tiny_grpc:zstd-dictionary'
+
+# Seconds a redis round trip waits for a connection of the pool to be free
+_REDIS_POOL_TIMEOUT = 1
+
+# Seconds sqlite waits for the lock held by another process
+_SQLITE_BUSY_TIMEOUT = 5
 
 log = logging.getLogger(__name__)
 
@@ -29,50 +60,516 @@ async def gen_key(val: str, *args: str) -> str:
     return unique_key
 
 
-class Cache(object):
-    """ Wrapper around aioredis to manage cache. """
+class PoolExhausted(ConnectionError):
+    """ No connection of the pool was freed in time, redis itself being
+    fine. """
 
-    def __init__(self, uri: str, ttl: int):
-        log.info("Initializing!")
-        self.uri = uri
+
+class _ConnectionPool(BlockingConnectionPool):
+    """ Waits for a connection to be free when all of them are in use. """
+
+    async def get_connection(self, command_name, *keys, **options):
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        except ConnectionError as ex:
+            if self.pool.empty():
+                # Every connection still in use, unlike a failure to connect
+                # which gives its connection back
+                raise PoolExhausted(str(ex)) from ex
+            raise
+
+
+class _SharedCache(object):
+    """ Compressed cache where concurrent lookups are sent together and
+    writes are sent in the background, skipped for a while after a failure.
+    Backends implement _fetch, _send and _send_if_absent. """
+
+    name = ''
+
+    def __init__(self, ttl: int, circuit_breaker_backoff: float = 1,
+                 compression: Compression | None = None):
         self.ttl = ttl
-        self.redis = from_url(
-            self.uri,
-            decode_responses=False
-        )
+        self.compression = compression or Compression()
+        # Whether the zstd dictionary in use was looked up, see _write
+        self._dictionary_loaded = False
+        self._training: asyncio.Task | None = None
+        # Lookups waiting to be sent, see get_with_ttl
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        # Writes waiting to be sent along with their TTL, see set
+        self._pending_writes: dict[str, tuple[bytes, float]] = {}
+        self._writer: asyncio.Task | None = None
+        # The cache is skipped until _open_until after a failure, the
+        # backoff doubling on every consecutive failure
+        self.circuit_breaker_backoff = circuit_breaker_backoff
+        self._backoff = circuit_breaker_backoff
+        self._open_until = 0.0
+
+    async def _fetch(self, keys: list[str]) -> list[tuple[bytes | None, float | None]]:
+        """ Read the given keys and their remaining TTL in seconds. """
+        raise NotImplementedError
+
+    async def _send(self, writes: list[tuple[str, bytes, float | None]]) -> None:
+        """ Write the given keys, for the given TTL in seconds if any. """
+        raise NotImplementedError
+
+    async def _send_if_absent(self, key: str, content: bytes) -> bool:
+        """ Write the given key with no TTL unless it exists, returns
+        whether it was written. """
+        raise NotImplementedError
+
+    def is_available(self) -> bool:
+        """ Whether the cache is not being skipped after a failure. """
+        return time.monotonic() >= self._open_until
+
+    def _succeeded(self) -> None:
+        """ Close the circuit breaker. """
+        self._backoff = self.circuit_breaker_backoff
+
+    def _failed(self, ex: Exception) -> None:
+        """ Open the circuit breaker, skipping the cache for a while. """
+        self._log_failure(ex)
+        self._open_until = time.monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, _MAX_CIRCUIT_BREAKER_BACKOFF)
+
+    def _log_failure(self, ex: Exception) -> None:
+        log.exception(ex)
+
+    async def get(self, key: str) -> Any | None:
+        """ Get the content of the given key. """
+        cached_ok, _ = await self.get_with_ttl(key)
+        return cached_ok
+
+    async def get_with_ttl(self, key: str) -> tuple[Any | None, float | None]:
+        """ Get the content of the given key and its remaining TTL in
+        seconds. Lookups issued concurrently are sent together in a single
+        round trip. """
+        if not self.is_available():
+            return None, None
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((key, future))
+        if len(self._pending) == 1:
+            loop.call_soon(lambda: asyncio.ensure_future(self._flush()))
+        return await future
 
-    async def _is_online(self) -> bool:
-        """ Check if the redis server is online. """
+    async def _flush(self) -> None:
+        """ Look up every pending key at once. """
+        pending, self._pending = self._pending, []
         try:
-            await self.redis.ping()
-        except ConnectionError:
-            log.error('cannot connect to redis: %s', self.uri)
-            return False
+            results = await self.get_many_with_ttl([key for key, _ in pending])
         except Exception as ex:  # pylint: disable=broad-except
-            log.exception(ex)
+            results = [ex] * len(pending)
+
+        for (_, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def get_many_with_ttl(self, keys: list[str]) -> list[tuple[Any | None, float | None]]:
+        """ Get the content of the given keys and their remaining TTL in
+        seconds, in a single round trip. """
+        if not self.is_available():
+            return [(None, None)] * len(keys)
+
+        try:
+            cached = await self._fetch(keys)
+        except Exception as ex:  # pylint: disable=broad-except
+            self._failed(ex)
+            return [(None, None)] * len(keys)
+        self._succeeded()
+
+        contents = await asyncio.gather(*[
+            self._decompress(cached_ok) for cached_ok, _ in cached
+        ])
+        return [
+            (content, ttl) if content is not None else (None, None)
+            for content, (_, ttl) in zip(contents, cached)
+        ]
+
+    async def _decompress(self, data: bytes | None) -> bytes | None:
+        """ Decompress a cached payload, None if it cannot be. """
+        if not data:
+            return None
+        try:
+            try:
+                return await self._run(self.compression.decompress, data)
+            except UnknownDictionary as ex:
+                # The dictionary in use, until the server that trained it
+                # stores it under its id
+                if not await self._load_dictionary(f"{_DICTIONARY_KEY}:{ex.dict_id}", False) and \
+                        not await self._load_dictionary(_DICTIONARY_KEY, False):
+                    return None
+                return await self._run(self.compression.decompress, data)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("cannot decompress a cached result")
+            return None
+
+    async def _run(self, fn, data: bytes) -> bytes:
+        """ Run fn on data, off the event loop if data is large. """
+        if len(data) < _OFF_LOOP_MIN_SIZE:
+            return fn(data)
+        return await asyncio.get_running_loop().run_in_executor(None, fn, data)
+
+    async def _load_dictionary(self, key: str, use: bool) -> bool:
+        """ Look up the zstd dictionary stored under the given key and make
+        it known, compressing with it from now on if use is set. """
+        try:
+            [(data, _)] = await self._fetch([key])
+        except Exception as ex:  # pylint: disable=broad-except
+            self._failed(ex)
+            return False
+        codec = self.compression.zstd()
+        if not data or codec is None:
             return False
+        dict_id = codec.use_dictionary(data) if use else codec.add_dictionary(data)
+        log.info("loaded zstd dictionary %s", dict_id)
         return True
 
-    async def get(self, key: str) -> Any | None:
-        """ Get the content of the given key. """
-        if not await self._is_online():
+    async def _train_dictionary(self) -> None:
+        """ Train a zstd dictionary on the sampled payloads and store it,
+        unless another server stored one first. """
+        codec = self.compression.zstd()
+        samples, codec.samples, codec.samples_size = codec.samples, [], 0
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(None, codec.train, samples)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("cannot train a zstd dictionary")
+            return
+        dict_id = codec.add_dictionary(data)
+        try:
+            stored = await self._send_if_absent(_DICTIONARY_KEY, data)
+            if stored:
+                # Only the dictionary in use is kept, the ones losing the
+                # race to another server are never used
+                await self._send([(f"{_DICTIONARY_KEY}:{dict_id}", data, None)])
+        except Exception as ex:  # pylint: disable=broad-except
+            self._failed(ex)
+            return
+        if stored:
+            codec.use_dictionary(data)
+            log.info("trained zstd dictionary %s on %s samples", dict_id, len(samples))
+        else:
+            await self._load_dictionary(_DICTIONARY_KEY, True)
+
+    async def set(self, key: str, content: bytes, ttl: float | None = None) -> None:
+        """ Set the content of the given key. The entry never lives longer
+        than the given ttl, if any. The write is sent in the background,
+        along with the other pending writes. """
+        if not self.is_available():
+            return None
+
+        ttl = self.ttl if ttl is None else min(self.ttl, ttl)
+        if ttl <= 0:
+            return None
+
+        if len(self._pending_writes) >= _MAX_PENDING_WRITES:
+            log.debug('too many pending writes, dropping %s', key)
             return None
 
-        async with self.redis as redis_client:
-            cached_ok = await redis_client.get(key)
-            if cached_ok:
-                return gzip.decompress(cached_ok).decode("utf-8")
+        self._pending_writes[key] = (content, ttl)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write())
         return None
 
-    async def set(self, key: str, content: str) -> None:
-        """ Set the content of the given key. """
-        if not await self._is_online():
+    async def _write(self) -> None:
+        """ Send the pending writes until there are none left. """
+        codec = self.compression.zstd()
+        if codec is not None and codec.dictionary_size and not self._dictionary_loaded:
+            self._dictionary_loaded = await self._load_dictionary(_DICTIONARY_KEY, True) or \
+                self.is_available()
+
+        while self._pending_writes:
+            writes, self._pending_writes = self._pending_writes, {}
+            if not self.is_available():
+                continue
+
+            compressed = await asyncio.gather(*[
+                self._run(self.compression.compress, content)
+                for content, _ in writes.values()
+            ])
+            if codec is not None and self._training is None and \
+                    any([codec.sample(content) for content, _ in writes.values()]):
+                self._training = asyncio.ensure_future(self._train_dictionary())
+
+            try:
+                await self._send([
+                    (key, content, ttl)
+                    for (key, (_, ttl)), content in zip(writes.items(), compressed)
+                ])
+            except Exception as ex:  # pylint: disable=broad-except
+                self._failed(ex)
+            else:
+                self._succeeded()
+
+    async def close(self) -> None:
+        """ Wait for the pending writes. """
+        if self._writer is not None:
+            await self._writer
+        if self._training is not None:
+            await self._training
+
+
+class Cache(_SharedCache):
+    """ Wrapper around aioredis to manage cache. """
+
+    name = 'redis'
+
+    def __init__(self, uri: str, ttl: int, max_connections: int = 16,
+                 circuit_breaker_backoff: float = 1,
+                 compression: Compression | None = None):
+        log.info("Initializing!")
+        super().__init__(ttl, circuit_breaker_backoff, compression)
+        self.uri = uri
+        self.redis = Redis(connection_pool=_ConnectionPool.from_url(
+            self.uri,
+            decode_responses=False,
+            max_connections=max_connections,
+            timeout=_REDIS_POOL_TIMEOUT,
+        ))
+
+    def _failed(self, ex: Exception) -> None:
+        if isinstance(ex, PoolExhausted):
+            # Too many round trips at once, not a reason to skip redis
+            log.warning('no redis connection free within %ss', _REDIS_POOL_TIMEOUT)
+            return
+        super()._failed(ex)
+
+    def _log_failure(self, ex: Exception) -> None:
+        if isinstance(ex, ConnectionError):
+            log.error('cannot connect to redis: %s, skipping it for %ss',
+                      self.uri, self._backoff)
+        else:
+            log.exception(ex)
+
+    async def _fetch(self, keys: list[str]) -> list[tuple[bytes | None, float | None]]:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.mget(keys)
+        for key in keys:
+            pipe.pttl(key)
+        with REDIS_SECONDS.labels('get').time():
+            cached, *pttls = await pipe.execute()
+        return [
+            (cached_ok, pttl / 1000 if pttl >= 0 else None)
+            for cached_ok, pttl in zip(cached, pttls)
+        ]
+
+    async def _send(self, writes: list[tuple[str, bytes, float | None]]) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        for key, content, ttl in writes:
+            pipe.set(key, content,
+                     px=max(int(ttl * 1000), 1) if ttl is not None else None)
+        with REDIS_SECONDS.labels('set').time():
+            await pipe.execute()
+
+    async def _send_if_absent(self, key: str, content: bytes) -> bool:
+        return bool(await self.redis.set(key, content, nx=True))
+
+    async def close(self) -> None:
+        """ Wait for the pending writes and close the connection pool. """
+        await super().close()
+        await self.redis.close()
+        await self.redis.connection_pool.disconnect()
+
+
+class SqliteCache(_SharedCache):
+    """ Cache kept in a local sqlite database in WAL mode, surviving
+    restarts with no network hop. All queries run in a single thread of its
+    own. Expired entries are dropped and, past max_bytes, the entries
+    expiring first are evicted by a background compaction, run every
+    compaction_interval seconds or as soon as the database grows too big. """
+
+    name = 'sqlite'
+
+    def __init__(self, path: str, ttl: int, max_bytes: int,
+                 compaction_interval: float = 300,
+                 circuit_breaker_backoff: float = 1,
+                 compression: Compression | None = None):
+        log.info("Initializing!")
+        super().__init__(ttl, circuit_breaker_backoff, compression)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compaction_interval = compaction_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-cache')
+        self._db = self._executor.submit(self._connect).result()
+        # Upper bound of the size of the entries, replaced ones counting
+        # twice until the next compaction
+        self.size = self._executor.submit(self._size).result()
+        self._compactor: asyncio.Task | None = None
+        self._compact_now = asyncio.Event()
+
+    def _connect(self) -> sqlite3.Connection:
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=_SQLITE_BUSY_TIMEOUT, isolation_level=None)
+        # Only effective on a new database, so freed pages can be given
+        # back by the compaction
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+            " expires_at REAL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+        return db
+
+    def _size(self) -> int:
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    async def _query(self, operation: str, fn, *args) -> Any:
+        """ Run fn in the thread of the database. """
+        loop = asyncio.get_running_loop()
+        with SQLITE_SECONDS.labels(operation).time():
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _fetch(self, keys: list[str]) -> list[tuple[bytes | None, float | None]]:
+        return await self._query('get', self._select, keys)
+
+    def _select(self, keys: list[str]) -> list[tuple[bytes | None, float | None]]:
+        now = time.time()
+        rows = {}
+        # Within the default limit of 999 variables per query
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows.update((key, (value, expires_at)) for key, value, expires_at in self._db.execute(
+                f"SELECT key, value, expires_at FROM cache WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk))
+        results = []
+        for key in keys:
+            value, expires_at = rows.get(key, (None, None))
+            if expires_at is not None and expires_at <= now:
+                value = None
+            results.append((value, expires_at - now if expires_at is not None and value else None))
+        return results
+
+    async def _send(self, writes: list[tuple[str, bytes, float | None]]) -> None:
+        await self._query('set', self._insert, writes)
+        self.size += sum(len(content) for _, content, _ in writes)
+        if self.size > self.max_bytes:
+            self._compact_now.set()
+        if self._compactor is None:
+            self._compactor = asyncio.ensure_future(self._compact_periodically())
+
+    def _insert(self, writes: list[tuple[str, bytes, float | None]]) -> None:
+        now = time.time()
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, size, expires_at) VALUES (?, ?, ?, ?)",
+                [(key, content, len(content), now + ttl if ttl is not None else None)
+                 for key, content, ttl in writes])
+
+    async def _send_if_absent(self, key: str, content: bytes) -> bool:
+        return await self._query('set', self._insert_if_absent, key, content)
+
+    def _insert_if_absent(self, key: str, content: bytes) -> bool:
+        cursor = self._db.execute(
+            "INSERT OR IGNORE INTO cache (key, value, size, expires_at) VALUES (?, ?, ?, NULL)",
+            (key, content, len(content)))
+        return cursor.rowcount > 0
+
+    def _compact(self) -> int:
+        """ Drop the expired entries, evict the ones expiring first past
+        max_bytes and give the freed pages back. Returns the new size. """
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            # Entries with no TTL, the zstd dictionaries, are never evicted
+            row = self._db.execute(
+                "SELECT expires_at FROM ("
+                " SELECT expires_at, SUM(size) OVER (ORDER BY expires_at DESC NULLS FIRST, key) AS kept"
+                " FROM cache) WHERE kept > ? AND expires_at IS NOT NULL"
+                " ORDER BY expires_at DESC LIMIT 1",
+                (self.max_bytes,)).fetchone()
+            if row is not None:
+                self._db.execute("DELETE FROM cache WHERE expires_at <= ?", row)
+        self._db.execute("PRAGMA incremental_vacuum")
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return self._size()
+
+    async def _compact_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._compact_now.wait(), self.compaction_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._compact_now.clear()
+            try:
+                self.size = await self._query('compact', self._compact)
+            except Exception as ex:  # pylint: disable=broad-except
+                self._failed(ex)
+
+    async def close(self) -> None:
+        """ Wait for the pending writes and close the database. """
+        await super().close()
+        if self._compactor is not None:
+            self._compactor.cancel()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._db.close)
+        self._executor.shutdown()
+
+
+class MemoryCache(object):
+    """ Bounded in-process LRU cache meant to sit in front of Cache. """
+
+    def __init__(self, max_bytes: int, ttl: int):
+        log.info("Initializing!")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # key -> (expiration of the entry, expiration of the content, content)
+        # both as per time.monotonic()
+        self.entries: OrderedDict[str, tuple[float, float, bytes]] = OrderedDict()
+
+    def _evict(self, key: str) -> None:
+        """ Remove the given key from the cache. """
+        _, _, content = self.entries.pop(key)
+        self.size -= len(content)
+
+    async def get(self, key: str) -> Any | None:
+        """ Get the content of the given key. """
+        cached_ok, _ = await self.get_with_ttl(key)
+        return cached_ok
+
+    async def get_with_ttl(self, key: str) -> tuple[Any | None, float | None]:
+        """ Get the content of the given key and the remaining TTL of the
+        content in seconds, as given when it was set. """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, None
+
+        now = time.monotonic()
+        expires_at, content_expires_at, content = entry
+        if expires_at <= now:
+            self._evict(key)
+            return None, None
+
+        self.entries.move_to_end(key)
+        return content, content_expires_at - now
+
+    async def set(self, key: str, content: bytes, ttl: float | None = None) -> None:
+        """ Set the content of the given key. The entry never lives longer
+        than the given ttl, if any. """
+        if key in self.entries:
+            self._evict(key)
+
+        size = len(content)
+        if size > self.max_bytes:
+            return None
+
+        content_ttl = self.ttl if ttl is None else ttl
+        ttl = min(self.ttl, content_ttl)
+        if ttl <= 0:
             return None
 
-        async with self.redis as redis_client:
-            await redis_client.set(
-                key,
-                gzip.compress(content.encode("utf-8")),
-                ex=self.ttl
-            )
+        now = time.monotonic()
+        self.entries[key] = (now + ttl, now + content_ttl, content)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._evict(next(iter(self.entries)))
         return None
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import gzip
+import threading
+from typing import Any
+
+from prometheus_client import Counter, Histogram
+
+from .metrics import _REGISTRY
+
+COMPRESSION_SECONDS = Histogram('cache_compression_seconds', 'Time spent compressing and decompressing cached results', ['codec', 'operation'], registry=_REGISTRY)
+COMPRESSION_BYTES = Counter('cache_compression_bytes_total', 'Total size of the cached results written, before and after compression', ['codec', 'state'], registry=_REGISTRY)
+
+# First bytes of a gzip stream, as written before every payload started with
+# the header of its codec
+_GZIP_MAGIC = b'\x1f\x8b'
+
+# Payloads are only sampled to train a dictionary up to this size, larger
+# ones do not benefit from a dictionary anyway
+_MAX_SAMPLE_SIZE = 64 * 1024
+
+# Bytes of samples gathered per byte of trained dictionary
+_SAMPLES_PER_DICTIONARY_BYTE = 100
+
+
+class Codec(object):
+    """ Compresses cached results, every payload starting with the header
+    byte of its codec so payloads of different codecs can be read back. """
+
+    name = 'none'
+    header = b'\x00'
+
+    def __init__(self, level: int = 0):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class GzipCodec(Codec):
+
+    name = 'gzip'
+    header = b'\x01'
+
+    def compress(self, data: bytes) -> bytes:
+        return gzip.compress(data, compresslevel=self.level or 6, mtime=0)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+
+class Lz4Codec(Codec):
+
+    name = 'lz4'
+    header = b'\x02'
+
+    def __init__(self, level: int = 0):
+        super().__init__(level)
+        # pylint: disable=import-outside-toplevel
+        import lz4.frame
+        self._lz4 = lz4.frame
+
+    def compress(self, data: bytes) -> bytes:
+        return self._lz4.compress(data, compression_level=self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._lz4.decompress(data)
+
+
+class ZstdCodec(Codec):
+    """ Zstandard, with a dictionary once one is trained or loaded. The id
+    of the dictionary is written in every frame, so payloads compressed
+    with an older dictionary can still be read as long as it is known. """
+
+    name = 'zstd'
+    header = b'\x03'
+
+    def __init__(self, level: int = 0, dictionary_size: int = 0):
+        super().__init__(level)
+        # pylint: disable=import-outside-toplevel
+        import zstandard
+        self._zstd = zstandard
+        self.dictionary_size = dictionary_size
+        self.dictionary: Any | None = None
+        self.dictionaries: dict[int, Any] = {}
+        self.samples: list[bytes] = []
+        self.samples_size = 0
+        # Compressors and decompressors are not thread safe
+        self._local = threading.local()
+
+    def _compressor(self):
+        dict_id = self.dictionary.dict_id() if self.dictionary is not None else 0
+        compressors = self._local.__dict__.setdefault('compressors', {})
+        if dict_id not in compressors:
+            compressors[dict_id] = self._zstd.ZstdCompressor(
+                level=self.level or 3, dict_data=self.dictionary)
+        return compressors[dict_id]
+
+    def _decompressor(self, dict_id: int):
+        decompressors = self._local.__dict__.setdefault('decompressors', {})
+        if dict_id not in decompressors:
+            decompressors[dict_id] = self._zstd.ZstdDecompressor(
+                dict_data=self.dictionaries.get(dict_id))
+        return decompressors[dict_id]
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor().compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor(self.dictionary_id(data)).decompress(data)
+
+    def dictionary_id(self, data: bytes) -> int:
+        """ Id of the dictionary the given frame was compressed with, 0 if
+        none. """
+        return self._zstd.get_frame_parameters(data).dict_id
+
+    def add_dictionary(self, data: bytes) -> int:
+        """ Make the given dictionary known, returns its id. """
+        dictionary = self._zstd.ZstdCompressionDict(data)
+        self.dictionaries[dictionary.dict_id()] = dictionary
+        return dictionary.dict_id()
+
+    def use_dictionary(self, data: bytes) -> int:
+        """ Compress with the given dictionary from now on, returns its
+        id. """
+        dict_id = self.add_dictionary(data)
+        self.dictionary = self.dictionaries[dict_id]
+        self.samples, self.samples_size = [], 0
+        return dict_id
+
+    def sample(self, data: bytes) -> bool:
+        """ Keep the given payload to train a dictionary with, returns
+        whether there are enough samples to train it. """
+        if not self.dictionary_size or self.dictionary is not None:
+            return False
+        if len(data) <= _MAX_SAMPLE_SIZE:
+            self.samples.append(data)
+            self.samples_size += len(data)
+        return self.samples_size >= self.dictionary_size * _SAMPLES_PER_DICTIONARY_BYTE
+
+    def train(self, samples: list[bytes]) -> bytes:
+        """ Train a dictionary on the given samples. """
+        return self._zstd.train_dictionary(self.dictionary_size, samples).as_bytes()
+
+
+CODECS = {codec.name: codec for codec in (Codec, GzipCodec, Lz4Codec, ZstdCodec)}
+
+
+class UnknownDictionary(Exception):
+    """ A payload was compressed with a dictionary that is not known. """
+
+    def __init__(self, dict_id: int):
+        super().__init__(f"unknown zstd dictionary {dict_id}")
+        self.dict_id = dict_id
+
+
+class Compression(object):
+    """ Compresses with a single codec, but reads back the payloads of any
+    codec, including the bare gzip of older versions. """
+
+    def __init__(self, codec: str = 'gzip', level: int = 0, dictionary_size: int = 0):
+        if codec == ZstdCodec.name:
+            self.codec = ZstdCodec(level, dictionary_size)
+        else:
+            self.codec = CODECS[codec](level)
+        self._decoders: dict[bytes, Codec] = {self.codec.header: self.codec}
+
+    def _decoder(self, header: bytes) -> Codec:
+        """ Codec of the given header, built on first use. """
+        if header not in self._decoders:
+            codec = next((c for c in CODECS.values() if c.header == header), None)
+            if codec is None:
+                raise ValueError(f"unknown compression header {header!r}")
+            self._decoders[header] = codec()
+        return self._decoders[header]
+
+    def compress(self, data: bytes) -> bytes:
+        with COMPRESSION_SECONDS.labels(self.codec.name, 'compress').time():
+            compressed = self.codec.header + self.codec.compress(data)
+        COMPRESSION_BYTES.labels(self.codec.name, 'raw').inc(len(data))
+        COMPRESSION_BYTES.labels(self.codec.name, 'compressed').inc(len(compressed))
+        return compressed
+
+    def decompress(self, data: bytes) -> bytes:
+        """ Decompress the given payload, raises UnknownDictionary when it
+        needs a zstd dictionary that is not known yet. """
+        if data[:2] == _GZIP_MAGIC:
+            codec, payload = self._decoder(GzipCodec.header), data
+        else:
+            codec, payload = self._decoder(data[:1]), data[1:]
+        if isinstance(codec, ZstdCodec):
+            dict_id = codec.dictionary_id(payload)
+            if dict_id and dict_id not in codec.dictionaries:
+                raise UnknownDictionary(dict_id)
+        with COMPRESSION_SECONDS.labels(codec.name, 'decompress').time():
+            return codec.decompress(payload)
+
+    def zstd(self) -> ZstdCodec | None:
+        """ The codec holding the zstd dictionaries, if any. """
+        codec = self._decoders.get(ZstdCodec.header)
+        return codec if isinstance(codec, ZstdCodec) else None
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Callable
+
+import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
+from prometheus_client import Gauge
+
+from .metrics import _REGISTRY
+
+HEALTH_SERVING = Gauge('health_serving', 'Whether the server reports itself as serving to the health checks', multiprocess_mode='liveall', registry=_REGISTRY)
+
+# Trailer of every call holding the serialized LoadReport, as read by ORCA
+# aware load balancers
+LOAD_REPORT_KEY = 'endpoint-load-metrics-bin'
+
+log = logging.getLogger(__name__)
+
+
+class HealthMonitor(object):
+    """ Serves the standard grpc.health.v1 service, reporting the given
+    services as serving as long as the server can take more requests,
+    checked every `interval` seconds, and as not serving once it shuts
+    down. """
+
+    def __init__(self, server: grpc.aio.Server, services: list[str],
+                 serving: Callable[[], bool], interval: float):
+        self.services = [health.OVERALL_HEALTH] + services
+        self.serving = serving
+        self.interval = interval
+        self.servicer = health.aio.HealthServicer()
+        health_pb2_grpc.add_HealthServicer_to_server(self.servicer, server)
+        self._status: int | None = None
+        self._task: asyncio.Task | None = None
+
+    async def _set(self, status: int) -> None:
+        if status == self._status:
+            return
+        if self._status is not None:
+            log.info("health status changed to %s",
+                     health_pb2.HealthCheckResponse.ServingStatus.Name(status))
+        self._status = status
+        HEALTH_SERVING.set(status == health_pb2.HealthCheckResponse.SERVING)
+        for service in self.services:
+            await self.servicer.set(service, status)
+
+    async def _run(self) -> None:
+        while True:
+            await self._set(health_pb2.HealthCheckResponse.SERVING if self.serving()
+                            else health_pb2.HealthCheckResponse.NOT_SERVING)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """ Report every service as not serving for good, so the clients
+        move away while the server drains. """
+        if self._task is not None:
+            self._task.cancel()
+        HEALTH_SERVING.set(0)
+        await self.servicer.enter_graceful_shutdown()
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from collections import deque
+
+from prometheus_client import Counter
+
+from .metrics import _REGISTRY
+
+HEDGE_TOTAL = Counter('extraction_hedge_total', 'Total number of extraction attempts hedged by a second one', registry=_REGISTRY)
+HEDGE_WON_TOTAL = Counter('extraction_hedge_won_total', 'Total number of hedges finished before the attempt they hedged', registry=_REGISTRY)
+
+# Number of recent extraction times the hedging delay is computed from
+_SAMPLES = 256
+
+# No hedging until this many extraction times are known
+_MIN_SAMPLES = 20
+
+# Max number of hedges saved up by the budget, fired at once at worst
+_MAX_TOKENS = 10
+
+
+class Hedging(object):
+    """ Tells when a slow extraction attempt is worth a second one, through
+    another proxy and on another worker: once it took longer than the given
+    percentile of the recent extraction times. The extra attempts are kept
+    within `budget` times the number of attempts. """
+
+    def __init__(self, percentile: float, budget: float):
+        self.percentile = percentile
+        self.budget = budget
+        self.tokens = 0.0
+        self._samples: deque[float] = deque(maxlen=_SAMPLES)
+
+    def observe(self, seconds: float) -> None:
+        """ Record the time a successful attempt took. """
+        self._samples.append(seconds)
+
+    def delay(self) -> float | None:
+        """ Seconds after which the attempt being started is to be hedged,
+        None until enough extraction times are known. """
+        self.tokens = min(self.tokens + self.budget, _MAX_TOKENS)
+        if len(self._samples) < _MIN_SAMPLES:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(int(len(samples) * self.percentile / 100), len(samples) - 1)]
+
+    def spend(self) -> bool:
+        """ Whether the budget allows one more hedge, taking it if so. """
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Callable, NamedTuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .admission import Call, QueueFull
+from .metrics import _REGISTRY
+
+SITE_RUNNING = Gauge('site_running', 'Number of extractions running, by site limit', ['limit'], multiprocess_mode='livesum', registry=_REGISTRY)
+SITE_WAITING = Gauge('site_waiting', 'Number of extractions waiting for their site limit', ['limit'], multiprocess_mode='livesum', registry=_REGISTRY)
+SITE_WAIT_SECONDS = Histogram('site_wait_seconds', 'Time spent by extractions waiting for their site limit', ['limit'], registry=_REGISTRY)
+SITE_REJECTED_TOTAL = Counter('site_rejected_total', 'Total number of extractions rejected by their site limit', ['limit'], registry=_REGISTRY)
+
+# Limit of the sites with no limit of their own
+DEFAULT = '*'
+
+# Idle sites are forgotten past this number of known sites
+_MAX_SITES = 1024
+
+
+class Limit(NamedTuple):
+    """ Extractions per second, burst of extractions above that rate and
+    max number of extractions at once, 0 meaning no limit. """
+    rate: float
+    burst: float
+    concurrency: int
+
+
+def parse_limits(spec: str, share: int = 1) -> dict[str, Limit]:
+    """ Parse a comma separated list of SITE=RATE/BURST/CONCURRENCY, where
+    SITE is an extractor (eg: YoutubeTab or youtube:tab), a host (eg:
+    vimeo.com, which covers its subdomains too) or * for every other site.
+    Limits are divided by share, the number of servers enforcing them. """
+    limits = {}
+    for item in filter(None, (item.strip() for item in spec.split(','))):
+        site, _, values = item.partition('=')
+        rate, burst, concurrency = (values.split('/') + ['0', '0'])[:3]
+        rate, burst, concurrency = float(rate), float(burst), int(concurrency)
+        limits[site.strip().lower()] = Limit(
+            rate / share,
+            max(burst / share, 1) if rate else 0,
+            max(math.ceil(concurrency / share), 1) if concurrency else 0,
+        )
+    return limits
+
+
+class _Site(object):
+    """ Token bucket and running extractions of a single site. """
+
+    def __init__(self, name: str, limit: Limit):
+        self.name = name
+        self.limit = limit
+        self.tokens = limit.burst
+        self.updated = time.monotonic()
+        self.running = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.timer: asyncio.TimerHandle | None = None
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.tokens + (now - self.updated) * self.limit.rate,
+                          self.limit.burst)
+        self.updated = now
+
+    def idle(self) -> bool:
+        self.refill(time.monotonic())
+        return not self.running and not self.waiters and \
+            self.tokens >= self.limit.burst
+
+
+class SiteLimiter(object):
+    """ Rate limits and caps the concurrent extractions of every site, an
+    extractor or a host, before they are sent to the process pool. Each
+    site waits on its own, so a busy one never holds the others back, and
+    up to `max_queue` extractions of a site wait, anything else is
+    rejected unless its call was already admitted. """
+
+    def __init__(self, limits: dict[str, Limit], max_queue: int):
+        self.limits = limits
+        self.max_queue = max_queue
+        self._sites: dict[str, _Site] = {}
+
+    def limit(self, extractor: list[str], host: str) -> tuple[str, str] | None:
+        """ Name of the limit of an extraction by the given extractor (its
+        names) from the given host, and the site it is counted against. """
+        for name in extractor:
+            if name.lower() in self.limits:
+                return name.lower(), name.lower()
+        parts = host.lower().split('.')
+        for i in range(len(parts) - 1):
+            domain = '.'.join(parts[i:])
+            if domain in self.limits:
+                return domain, domain
+        if DEFAULT in self.limits:
+            return DEFAULT, extractor[0] if extractor else host
+        return None
+
+    def _site(self, limit: str, name: str) -> _Site:
+        if name not in self._sites:
+            if len(self._sites) >= _MAX_SITES:
+                for idle in [n for n, site in self._sites.items() if site.idle()]:
+                    del self._sites[idle]
+            self._sites[name] = _Site(limit, self.limits[limit])
+        return self._sites[name]
+
+    def _wake(self, site: _Site) -> None:
+        """ Let the waiting extractions of the site go while its limits
+        allow, retrying once a token is due. """
+        site.timer = None
+        while site.waiters:
+            if site.limit.concurrency and site.running >= site.limit.concurrency:
+                return
+            if site.waiters[0].done():
+                site.waiters.popleft()
+                continue
+            if site.limit.rate:
+                now = time.monotonic()
+                site.refill(now)
+                if site.tokens < 1:
+                    site.timer = asyncio.get_event_loop().call_later(
+                        (1 - site.tokens) / site.limit.rate, self._wake, site)
+                    return
+                site.tokens -= 1
+            site.running += 1
+            SITE_RUNNING.labels(site.name).inc()
+            site.waiters.popleft().set_result(None)
+
+    def _release(self, site: _Site) -> None:
+        site.running -= 1
+        SITE_RUNNING.labels(site.name).dec()
+        if site.timer is None:
+            self._wake(site)
+
+    async def acquire(self, limit: str, name: str,
+                      call: Call | None = None) -> Callable[[], None]:
+        """ Wait for the given site to allow one more extraction, part of
+        the given call if any, returns the callable to call once it is
+        done. """
+        site = self._site(limit, name)
+        if len(site.waiters) >= self.max_queue and (call is None or not call.admitted):
+            SITE_REJECTED_TOTAL.labels(site.name).inc()
+            raise QueueFull(f"too many extractions waiting for {site.name}")
+
+        future = asyncio.get_event_loop().create_future()
+        site.waiters.append(future)
+        if site.timer is None:
+            self._wake(site)
+        if future.done():
+            return lambda: self._release(site)
+
+        SITE_WAITING.labels(site.name).inc()
+        start = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Let go right before the cancellation
+                self._release(site)
+            elif future in site.waiters:
+                site.waiters.remove(future)
+            raise
+        finally:
+            SITE_WAITING.labels(site.name).dec()
+            SITE_WAIT_SECONDS.labels(site.name).observe(time.monotonic() - start)
+        return lambda: self._release(site)
@@ -1,4 +1,4 @@
-from prometheus_client import CollectorRegistry
+from prometheus_client import CollectorRegistry, values
 import glob
 import os
 
@@ -13,3 +13,12 @@ def prepare_metrics_directory(d: str) -> None:
     files = glob.glob(d + "/*")
     for f in files:
         os.remove(f)
+
+    # Metrics are defined on import, before the directory is known. Switch
+    # them to values stored in the directory, leaving their exposition to
+    # the MultiProcessCollector.
+    values.ValueClass = values.get_value_class()
+    for collector in list(_REGISTRY._collector_to_names):
+        _REGISTRY.unregister(collector)
+        if collector._is_observable():
+            collector._metric_init()
@@ -71,6 +71,27 @@ def parse_opts(argv: list) -> argparse.Namespace:
         help='Compression algorithm for the server',
     )
 
+    grpc.add_argument(
+        '--grpc-processes',
+        default=os.getenv("GRPC_PROCESSES", 1),
+        type=int,
+        help='Number of server processes sharing the port, each with a slice of the youtube-dl workers',
+    )
+
+    grpc.add_argument(
+        '--grpc-call-concurrency',
+        default=os.getenv("GRPC_CALL_CONCURRENCY", 16),
+        type=int,
+        help='Max extractions of a single call waiting or running at once, a call being only rejected by a full queue before its first extraction, and max requests of a single batch or stream handled at once',
+    )
+
+    grpc.add_argument(
+        '--grpc-health-interval',
+        default=os.getenv("GRPC_HEALTH_INTERVAL", 1),
+        type=float,
+        help='Seconds between two updates of the grpc.health.v1 status, not serving while the admission queue is full or the process pool is broken',
+    )
+
     youtube_dl = parser.add_argument_group("youtube-dl")
 
     youtube_dl.add_argument(
@@ -102,6 +123,13 @@ def parse_opts(argv: list) -> argparse.Namespace:
         For example 'socks5://127.0.0.1:1080,http://127.0.0.1:8080'"
     )
 
+    youtube_dl.add_argument(
+        '--youtube-dl-proxy-quarantine',
+        default=os.getenv("YOUTUBE_DL_PROXY_QUARANTINE", 30),
+        type=float,
+        help="Seconds a failing proxy is left out, doubled on every consecutive failure",
+    )
+
     youtube_dl.add_argument(
         '--youtube-dl-cookies-file',
         default=os.getenv("YOUTUBE_DL_COOKIES_FILE", ""),
@@ -109,6 +137,138 @@ def parse_opts(argv: list) -> argparse.Namespace:
         help="File to read cookies from and dump cookie jar in"
     )
 
+    youtube_dl.add_argument(
+        '--youtube-dl-instance-cache-size',
+        default=os.getenv("YOUTUBE_DL_INSTANCE_CACHE_SIZE", 4),
+        type=int,
+        help="Number of ready to use youtube-dl instances kept by each worker",
+    )
+
+    youtube_dl.add_argument(
+        '--youtube-dl-max-queue',
+        default=os.getenv("YOUTUBE_DL_MAX_QUEUE", 64),
+        type=int,
+        help="Max number of extractions waiting for a worker, more are rejected unless their call already had one admitted",
+    )
+
+    youtube_dl.add_argument(
+        '--youtube-dl-site-limits',
+        default=os.getenv("YOUTUBE_DL_SITE_LIMITS", ""),
+        type=str,
+        help="Comma separated list of SITE=RATE/BURST/CONCURRENCY limiting the extractions per second, \
+        their burst and how many run at once for a site, an extractor or a host, * for every other site, \
+        0 for no limit, shared by the --grpc-processes servers. For example 'youtube:tab=0.5/2/1,vimeo.com=2/5/2,*=10/20/0'",
+    )
+
+    youtube_dl.add_argument(
+        '--youtube-dl-hedge-percentile',
+        default=os.getenv("YOUTUBE_DL_HEDGE_PERCENTILE", 0),
+        type=float,
+        help="Start a second extraction attempt through another proxy once the first one is slower than \
+        this percentile of the recent extractions, the first one to succeed wins, 0 to disable it",
+    )
+
+    youtube_dl.add_argument(
+        '--youtube-dl-hedge-budget',
+        default=os.getenv("YOUTUBE_DL_HEDGE_BUDGET", 0.05),
+        type=float,
+        help="Max number of second attempts per extraction attempt",
+    )
+
+    youtube_dl.add_argument(
+        '--youtube-dl-worker-max-tasks',
+        default=os.getenv("YOUTUBE_DL_WORKER_MAX_TASKS", 0),
+        type=int,
+        help="Replace the workers once they ran this many extractions each on average, 0 to never replace them",
+    )
+
+    youtube_dl.add_argument(
+        '--youtube-dl-worker-max-rss',
+        default=os.getenv("YOUTUBE_DL_WORKER_MAX_RSS", 0),
+        type=int,
+        help="Replace the workers once one of them uses more than this many bytes of memory, 0 for no limit",
+    )
+
+    youtube_dl.add_argument(
+        '--youtube-dl-worker-max-age',
+        default=os.getenv("YOUTUBE_DL_WORKER_MAX_AGE", 0),
+        type=float,
+        help="Replace the workers once they are this many seconds old, 0 for no limit",
+    )
+
+    cache = parser.add_argument_group("cache")
+
+    cache.add_argument(
+        '--cache-refresh-window',
+        type=float,
+        default=os.getenv("CACHE_REFRESH_WINDOW", 0),
+        help='Cached results expiring within this many seconds are served and refreshed in the background',
+    )
+
+    cache.add_argument(
+        '--cache-negative-ttl',
+        type=float,
+        default=os.getenv("CACHE_NEGATIVE_TTL", 300),
+        help='TTL for cached failures of private, removed or unsupported videos, 0 not to cache them',
+    )
+
+    cache.add_argument(
+        '--warmer-enable',
+        action='store_true',
+        default=os.getenv("WARMER_ENABLE", False),
+        help='Keep the cache warm for the requests of --warmer-file and the ones given to the Warm RPC, once a cache is enabled',
+    )
+
+    cache.add_argument(
+        '--warmer-file',
+        type=str,
+        default=os.getenv("WARMER_FILE", ""),
+        help='JSON file holding a list of ExtractInfoRequest to keep warm',
+    )
+
+    cache.add_argument(
+        '--warmer-concurrency',
+        type=int,
+        default=os.getenv("WARMER_CONCURRENCY", 1),
+        help='Max number of requests warmed at once, their entries waiting for a youtube-dl worker like live ones',
+    )
+
+    cache.add_argument(
+        '--warmer-interval',
+        type=float,
+        default=os.getenv("WARMER_INTERVAL", 3600),
+        help='Max seconds between two warmings of a request',
+    )
+
+    cache.add_argument(
+        '--warmer-lead',
+        type=float,
+        default=os.getenv("WARMER_LEAD", 120),
+        help='Requests are warmed this many seconds before their cached results expire',
+    )
+
+    cache.add_argument(
+        '--cache-compression',
+        type=str,
+        choices=["none", "gzip", "lz4", "zstd"],
+        default=os.getenv("CACHE_COMPRESSION", "gzip"),
+        help='Compression of the cached results, lz4 and zstd need the extras of the same name',
+    )
+
+    cache.add_argument(
+        '--cache-compression-level',
+        type=int,
+        default=os.getenv("CACHE_COMPRESSION_LEVEL", 0),
+        help='Compression level, 0 for the default of the compression algorithm',
+    )
+
+    cache.add_argument(
+        '--cache-zstd-dictionary-size',
+        type=int,
+        default=os.getenv("CACHE_ZSTD_DICTIONARY_SIZE", 112640),
+        help='Size of the zstd dictionary trained on the first cached results and shared with the other servers, 0 to disable it',
+    )
+
     redis = parser.add_argument_group("redis")
 
     redis.add_argument(
@@ -132,6 +292,80 @@ def parse_opts(argv: list) -> argparse.Namespace:
         help='TTL for cached results',
     )
 
+    redis.add_argument(
+        '--redis-max-connections',
+        type=int,
+        default=os.getenv("REDIS_MAX_CONNECTIONS", 16),
+        help='Size of the Redis connection pool, round trips wait for a free connection beyond that',
+    )
+
+    redis.add_argument(
+        '--redis-circuit-breaker-backoff',
+        type=float,
+        default=os.getenv("REDIS_CIRCUIT_BREAKER_BACKOFF", 1),
+        help='Seconds Redis is skipped after a failure, doubled on every consecutive failure',
+    )
+
+    sqlite = parser.add_argument_group("sqlite")
+
+    sqlite.add_argument(
+        '--sqlite-enable',
+        action='store_true',
+        default=os.getenv("SQLITE_ENABLE", False),
+        help='Enable the local sqlite cache, for a single node without Redis, not along with --redis-enable',
+    )
+
+    sqlite.add_argument(
+        '--sqlite-path',
+        type=str,
+        default=os.getenv("SQLITE_PATH", "/tmp/youtube_dl_tiny_grpc.sqlite"),
+        help='Path of the sqlite database',
+    )
+
+    sqlite.add_argument(
+        '--sqlite-ttl',
+        type=int,
+        default=os.getenv("SQLITE_TTL", 3600),
+        help='TTL for cached results',
+    )
+
+    sqlite.add_argument(
+        '--sqlite-max-bytes',
+        type=int,
+        default=os.getenv("SQLITE_MAX_BYTES", 1024 * 1024 * 1024),
+        help='Max size of the cached results, the ones expiring first being evicted past it',
+    )
+
+    sqlite.add_argument(
+        '--sqlite-compaction-interval',
+        type=float,
+        default=os.getenv("SQLITE_COMPACTION_INTERVAL", 300),
+        help='Seconds between two removals of the expired results from the database',
+    )
+
+    memory_cache = parser.add_argument_group("memory-cache")
+
+    memory_cache.add_argument(
+        '--memory-cache-enable',
+        action='store_true',
+        default=os.getenv("MEMORY_CACHE_ENABLE", False),
+        help='Enable the in-process cache in front of Redis or SQLite',
+    )
+
+    memory_cache.add_argument(
+        '--memory-cache-max-bytes',
+        type=int,
+        default=os.getenv("MEMORY_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+        help='Max size of the cached results kept in memory',
+    )
+
+    memory_cache.add_argument(
+        '--memory-cache-ttl',
+        type=int,
+        default=os.getenv("MEMORY_CACHE_TTL", 60),
+        help='TTL for results cached in memory, capped by --redis-ttl or --sqlite-ttl',
+    )
+
     general = parser.add_argument_group("general")
 
     general.add_argument(
@@ -155,6 +389,8 @@ def parse_opts(argv: list) -> argparse.Namespace:
     )
 
     args = parser.parse_args(argv)
+    if args.redis_enable and args.sqlite_enable:
+        parser.error("--redis-enable and --sqlite-enable cannot be used together")
 
     if args.verbose or args.debug is not None:
         print("configuration:")
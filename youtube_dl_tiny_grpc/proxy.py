@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import random
+import time
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter, Gauge
+
+from .metrics import _REGISTRY
+
+PROXY_SUCCESS_RATE = Gauge('proxy_success_rate', 'Moving average of the success rate of each proxy', ['proxy'], multiprocess_mode='liveall', registry=_REGISTRY)
+PROXY_LATENCY_SECONDS = Gauge('proxy_latency_seconds', 'Moving average of the extraction time through each proxy', ['proxy'], multiprocess_mode='liveall', registry=_REGISTRY)
+PROXY_QUARANTINED = Gauge('proxy_quarantined', 'Whether each proxy is quarantined', ['proxy'], multiprocess_mode='liveall', registry=_REGISTRY)
+PROXY_FAILURE_TOTAL = Counter('proxy_failure_total', 'Total number of extractions failed through each proxy', ['proxy'], registry=_REGISTRY)
+
+# Weight of the last extraction in the moving averages
+_EWMA_ALPHA = 0.2
+
+# Latency assumed for a proxy not used yet, in seconds, so new proxies get
+# a fair chance to be picked
+_DEFAULT_LATENCY = 1.0
+
+# Max number of seconds a proxy is quarantined for
+_MAX_QUARANTINE = 600
+
+
+def _label(proxy: str) -> str:
+    """Proxy url without its credentials, fit for a metric label."""
+    parts = urlsplit(proxy)
+    return f"{parts.scheme}://{parts.netloc.rpartition('@')[2]}" if parts.scheme else proxy
+
+
+class _Health(object):
+    """ Health of a single proxy. """
+
+    def __init__(self, proxy: str):
+        self.proxy = proxy
+        self.label = _label(proxy)
+        self.success_rate = 1.0
+        self.latency: float | None = None
+        self.failures = 0
+        self.quarantined_until = 0.0
+
+    def score(self) -> float:
+        """Higher is better: successful and fast proxies first."""
+        latency = self.latency if self.latency is not None else _DEFAULT_LATENCY
+        return max(self.success_rate, 0.01) / max(latency, 0.1)
+
+    def update_metrics(self, now: float) -> None:
+        PROXY_SUCCESS_RATE.labels(self.label).set(self.success_rate)
+        if self.latency is not None:
+            PROXY_LATENCY_SECONDS.labels(self.label).set(self.latency)
+        PROXY_QUARANTINED.labels(self.label).set(self.quarantined_until > now)
+
+
+class ProxyManager(object):
+    """ Picks the proxy of every extraction attempt, preferring the ones
+    with the best success rate and latency. A failing proxy is quarantined,
+    twice as long after every consecutive failure. Only lives in the server
+    process, so its state is shared by all the pool workers. """
+
+    def __init__(self, proxies: list[str], quarantine: float = 30):
+        self.quarantine = quarantine
+        self._health = {proxy: _Health(proxy) for proxy in proxies}
+        now = time.monotonic()
+        for health in self._health.values():
+            health.update_metrics(now)
+
+    def pick(self, exclude: list[str] = []) -> str:
+        """Pick a proxy, avoiding the quarantined ones and the excluded ones
+        (eg: the ones that already failed the extraction) when possible."""
+        now = time.monotonic()
+        for health in self._health.values():
+            PROXY_QUARANTINED.labels(health.label).set(health.quarantined_until > now)
+
+        available = [h for h in self._health.values() if h.quarantined_until <= now]
+        if not available:
+            # Better than nothing: the one closest to the end of its quarantine
+            available = [min(self._health.values(), key=lambda h: h.quarantined_until)]
+        candidates = [h for h in available if h.proxy not in exclude] or available
+        return random.choices(candidates, [h.score() for h in candidates])[0].proxy
+
+    def success(self, proxy: str, latency: float) -> None:
+        """Record an extraction that went through the proxy."""
+        health = self._health[proxy]
+        health.success_rate += _EWMA_ALPHA * (1 - health.success_rate)
+        if health.latency is None:
+            health.latency = latency
+        else:
+            health.latency += _EWMA_ALPHA * (latency - health.latency)
+        health.failures = 0
+        health.update_metrics(time.monotonic())
+
+    def failure(self, proxy: str) -> None:
+        """Record an extraction that failed because of the proxy and
+        quarantine it."""
+        health = self._health[proxy]
+        health.success_rate -= _EWMA_ALPHA * health.success_rate
+        health.failures += 1
+        now = time.monotonic()
+        health.quarantined_until = now + min(
+            self.quarantine * 2 ** (health.failures - 1), _MAX_QUARANTINE)
+        PROXY_FAILURE_TOTAL.labels(health.label).inc()
+        health.update_metrics(now)
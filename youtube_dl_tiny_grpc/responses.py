@@ -0,0 +1,316 @@
+from __future__ import annotations
+import json
+import re
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, NamedTuple
+
+from google.protobuf.json_format import ParseDict
+
+from .protobuf.youtube_dl_tiny_grpc_pb2 import ExtractInfoResponse
+
+# Cached responses start with this tag followed by the format version.
+# Anything else is a JSON encoded info dict as cached by older versions.
+_MAGIC = b'\x00YTDL'
+_VERSION = 1
+
+# Cached playlists only hold the references of their entries, each entry
+# being cached on its own.
+_INDEX_MAGIC = b'\x00YTDX'
+
+# Cached failures, answered right away until they expire
+_ERROR_MAGIC = b'\x00YTDE'
+
+# Flat listings of playlists, paged through without listing them again
+_LISTING_MAGIC = b'\x00YTDP'
+
+# Every serialized ExtractInfoResponse is prefixed by its length
+_LENGTH = struct.Struct('>I')
+
+# Extractions packing to at least this many bytes are sent back by the
+# pool workers through shared memory rather than pickled
+_SHARED_MEMORY_MIN_SIZE = 256 * 1024
+
+# Expiration timestamp of signed media urls, either as a query parameter
+# or as a path segment (eg: manifest urls)
+_EXPIRE = re.compile(r'[?&/]expire[=/](\d+)')
+
+
+def info_entries(info: dict) -> list:
+    """Return the list of videos in the given youtube-dl info dict."""
+    try:
+        return info['entries'][0]['entries']
+    except KeyError:
+        try:
+            return info['entries']
+        except KeyError:
+            return [info]
+
+
+def entry_ref(entry: dict) -> tuple[str, str, str] | None:
+    """Return the (extractor, id, url) reference of a video, either fully
+    extracted or from a flat playlist listing."""
+    extractor = entry.get('extractor_key') or entry.get('ie_key')
+    video_id = entry.get('id')
+    url = entry.get('webpage_url') or entry.get('url')
+    if not extractor or not video_id or not url:
+        return None
+    return extractor, video_id, url
+
+
+def url_expiry(info: dict) -> int | None:
+    """Return the earliest expiration timestamp among the signed media urls
+    of a video, if any."""
+    urls = [info.get('url')]
+    for field in ('formats', 'requested_formats'):
+        urls.extend(f.get('url') for f in info.get(field) or [])
+
+    expiries = [
+        int(match.group(1))
+        for match in (_EXPIRE.search(url) for url in urls if url)
+        if match
+    ]
+    return min(expiries, default=None)
+
+
+def valid_fields(paths: list[str]) -> bool:
+    """Whether every field mask path names a field of ExtractInfoResponse,
+    going through repeated messages too, eg: formats.url"""
+    for path in paths:
+        descriptor = ExtractInfoResponse.DESCRIPTOR
+        for name in path.split('.'):
+            if descriptor is None or name not in descriptor.fields_by_name:
+                return False
+            descriptor = descriptor.fields_by_name[name].message_type
+    return True
+
+
+def _fields_tree(paths: list[str]) -> dict:
+    """Turn field mask paths into a tree of field names, an empty subtree
+    selecting the whole field."""
+    tree: dict = {}
+    for path in paths:
+        node = tree
+        names = path.split('.')
+        for name in names[:-1]:
+            node = node.setdefault(name, {})
+            if node is None:
+                break
+        else:
+            node[names[-1]] = None
+    return tree
+
+
+def _project(value: Any, tree: dict | None) -> Any:
+    """Keep only the fields of the tree in the given value."""
+    if tree is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {
+            name: _project(value[name], subtree)
+            for name, subtree in tree.items() if name in value
+        }
+    return value
+
+
+def serialize_info(info: dict, fields: list[str] = []) -> list[bytes]:
+    """Build and serialize an ExtractInfoResponse for every video in the
+    given youtube-dl info dict, with only the given fields if any."""
+    entries = info_entries(info)
+    if fields:
+        tree = _fields_tree(fields)
+        entries = [_project(entry, tree) for entry in entries]
+
+    # FIXME: Yes, this is a hack.
+    # youtube_dl sometimes returns tuples for some repeated fields
+    # and ParseDict doesn't like that.
+    entries = json.loads(json.dumps(entries))
+
+    return [
+        ParseDict(
+            entry,
+            ExtractInfoResponse(),
+            ignore_unknown_fields=True).SerializeToString()
+        for entry in entries
+    ]
+
+
+def _varint(value: int) -> bytes:
+    """Encode an unsigned protobuf varint."""
+    chunks = bytearray()
+    while value > 0x7f:
+        chunks.append((value & 0x7f) | 0x80)
+        value >>= 7
+    chunks.append(value)
+    return bytes(chunks)
+
+
+def frame_batch_response(index: int, response: bytes) -> bytes:
+    """Serialize a BatchExtractInfoResponse around an already serialized
+    ExtractInfoResponse, without parsing it back."""
+    # Fields 1 (index, varint) and 2 (response, length delimited)
+    return b'\x08' + _varint(index) + b'\x12' + _varint(len(response)) + response
+
+
+def pack(responses: list[bytes]) -> bytes:
+    """Pack serialized responses into a single cache entry."""
+    chunks = [_MAGIC, bytes((_VERSION,))]
+    for response in responses:
+        chunks.append(_LENGTH.pack(len(response)))
+        chunks.append(response)
+    return b''.join(chunks)
+
+
+def unpack(content: bytes) -> list[bytes]:
+    """Unpack the serialized responses of a cache entry."""
+    if not content.startswith(_MAGIC):
+        return serialize_info(json.loads(content))
+
+    version = content[len(_MAGIC)]
+    if version != _VERSION:
+        raise ValueError(f"unknown cache format version: {version}")
+
+    responses = []
+    view = memoryview(content)
+    offset = len(_MAGIC) + 1
+    while offset < len(view):
+        (length,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        responses.append(bytes(view[offset:offset + length]))
+        offset += length
+    return responses
+
+
+class Extraction(NamedTuple):
+    """Result of an extraction as sent back by a pool worker: its entries
+    already serialized and packed, see extraction and receive."""
+    extractor: str
+    refs: list[tuple[str, str, str] | None]
+    expiries: list[int | None]
+    # Size of the packed responses of each entry
+    sizes: list[int]
+    # The packed responses of every entry, one after the other, unless
+    # left in shared memory under the given name
+    data: bytes | None
+    shared_memory: str | None
+    serialization_seconds: float
+
+    def packed(self) -> list[bytes]:
+        """The packed responses of every entry, see receive."""
+        packed = []
+        offset = 0
+        for size in self.sizes:
+            packed.append(self.data[offset:offset + size])
+            offset += size
+        return packed
+
+    def responses(self) -> list[bytes]:
+        """The serialized responses of every entry, see receive."""
+        return [r for packed in self.packed() for r in unpack(packed)]
+
+
+def extraction(info: dict, fields: list[str] = []) -> Extraction:
+    """Serialize and pack every video in the given youtube-dl info dict,
+    meant to be called in the pool workers."""
+    start = time.monotonic()
+    entries = info_entries(info)
+    packed = [pack(serialize_info(entry, fields)) for entry in entries]
+    data = b''.join(packed)
+    seconds = time.monotonic() - start
+
+    shared_memory = None
+    if len(data) >= _SHARED_MEMORY_MIN_SIZE:
+        shm = SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        # From now on owned by the process receiving it, see receive
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+        shared_memory, data = shm.name, None
+
+    return Extraction(
+        info.get('extractor_key') or info.get('ie_key') or 'unknown',
+        [entry_ref(entry) for entry in entries],
+        [url_expiry(entry) for entry in entries],
+        [len(p) for p in packed],
+        data,
+        shared_memory,
+        seconds,
+    )
+
+
+def receive(result: Extraction) -> Extraction:
+    """Move the data of an extraction sent back by a pool worker out of
+    shared memory, if there, releasing it. Must be called exactly once."""
+    if result.shared_memory is None:
+        return result
+
+    shm = SharedMemory(result.shared_memory)
+    try:
+        data = bytes(shm.buf[:sum(result.sizes)])
+    finally:
+        shm.close()
+        shm.unlink()
+    return result._replace(data=data, shared_memory=None)
+
+
+def pack_index(refs: list[tuple[str, str, str]]) -> bytes:
+    """Pack the entry references of a playlist into a single cache entry."""
+    return _INDEX_MAGIC + bytes((_VERSION,)) + json.dumps(refs).encode()
+
+
+def is_index(content: bytes) -> bool:
+    """Whether the cache entry holds entry references."""
+    return content.startswith(_INDEX_MAGIC)
+
+
+def unpack_index(content: bytes) -> list[tuple[str, str, str]]:
+    """Unpack the entry references of a cache entry."""
+    version = content[len(_INDEX_MAGIC)]
+    if version != _VERSION:
+        raise ValueError(f"unknown cache format version: {version}")
+    return [tuple(ref) for ref in json.loads(content[len(_INDEX_MAGIC) + 1:])]
+
+
+def pack_error(code: str, message: str) -> bytes:
+    """Pack a failed extraction, with the name of its gRPC status, into a
+    single cache entry."""
+    return _ERROR_MAGIC + bytes((_VERSION,)) + json.dumps([code, message]).encode()
+
+
+def is_error(content: bytes) -> bool:
+    """Whether the cache entry holds a failed extraction."""
+    return content.startswith(_ERROR_MAGIC)
+
+
+def unpack_error(content: bytes) -> tuple[str, str]:
+    """Unpack the gRPC status name and the message of a cached failure."""
+    version = content[len(_ERROR_MAGIC)]
+    if version != _VERSION:
+        raise ValueError(f"unknown cache format version: {version}")
+    code, message = json.loads(content[len(_ERROR_MAGIC) + 1:])
+    return code, message
+
+
+def pack_listing(refs: list[tuple[str, str, str]], complete: bool) -> bytes:
+    """Pack the entry references listed so far of a playlist, and whether
+    that is all of them, into a single cache entry."""
+    return _LISTING_MAGIC + bytes((_VERSION,)) + json.dumps([complete, refs]).encode()
+
+
+def is_listing(content: bytes) -> bool:
+    """Whether the cache entry holds the listing of a playlist."""
+    return content.startswith(_LISTING_MAGIC)
+
+
+def unpack_listing(content: bytes) -> tuple[list[tuple[str, str, str]], bool]:
+    """Unpack the entry references of a cached listing and whether that is
+    all of them."""
+    version = content[len(_LISTING_MAGIC)]
+    if version != _VERSION:
+        raise ValueError(f"unknown cache format version: {version}")
+    complete, refs = json.loads(content[len(_LISTING_MAGIC) + 1:])
+    return [tuple(ref) for ref in refs], complete
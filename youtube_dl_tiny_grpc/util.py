@@ -1,6 +1,27 @@
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+import resource
 import signal
+import threading
+import time
 
+from concurrent.futures import Executor, Future
 from concurrent.futures import ProcessPoolExecutor as PoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from prometheus_client import Counter
+
+from .metrics import _REGISTRY
+
+POOL_RECYCLE_TOTAL = Counter('pool_recycle_total', 'Total number of process pools replaced, by reason', ['reason'], registry=_REGISTRY)
+
+# Seconds between two checks of the memory used by the pool workers
+_RSS_CHECK_INTERVAL = 10
+
+log = logging.getLogger(__name__)
 
 
 def port_is_in_use(port: int) -> bool:
@@ -9,13 +30,174 @@ def port_is_in_use(port: int) -> bool:
         return s.connect_ex(('localhost', port)) == 0
 
 
+def _rss(pid: int) -> int:
+    """ Resident memory of the given process in bytes, 0 if unknown. """
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
 class ProcessPoolExecutor(PoolExecutor):
-    """ A ProcessPoolExecutor that ignores SIGINT signals. """
+    """ A ProcessPoolExecutor that ignores SIGINT signals. An initializer
+    given by the caller still runs in every worker. """
 
     def __init__(self, *args, **kwargs):
+        kwargs['initargs'] = (kwargs.pop('initializer', None),
+                              kwargs.pop('initargs', ()))
         kwargs['initializer'] = ProcessPoolExecutor.initializer
         super().__init__(*args, **kwargs)
 
     @staticmethod
-    def initializer():
+    def initializer(initializer=None, initargs=()):
         signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if initializer is not None:
+            initializer(*initargs)
+
+
+class RecyclingProcessPool(Executor):
+    """ A ProcessPoolExecutor replaced by a new one once its workers ran
+    max_tasks tasks each on average, one of them uses more than max_rss
+    bytes or it is older than max_age seconds, 0 meaning no limit.
+
+    Every worker is started right away and runs the initializer before the
+    pool is used, see warmed. The replacement is started the same way and
+    only takes over once warmed up, the old pool finishing the tasks it
+    was given in the meantime.
+
+    A pool broken by the abrupt death of a worker is replaced right away,
+    its pending tasks failing, unless it broke before it was warmed up.
+
+    Workers are forked from a fork server started along the first pool, with
+    the module of the initializer already imported, rather than from the
+    server process whose threads and sockets would be copied in a broken
+    state. """
+
+    def __init__(self, max_workers: int, max_tasks: int = 0, max_rss: int = 0,
+                 max_age: float = 0, **kwargs):
+        self.max_workers = max_workers
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.max_age = max_age
+        if 'mp_context' not in kwargs:
+            kwargs['mp_context'] = multiprocessing.get_context('forkserver')
+            if kwargs.get('initializer') is not None:
+                kwargs['mp_context'].set_forkserver_preload([kwargs['initializer'].__module__])
+        self._kwargs = kwargs
+        # Reentrant as a replacement may be warmed up right away, see _replace
+        self._lock = threading.RLock()
+        self._pool, self._warming = self._spawn()
+        self._next: PoolExecutor | None = None
+        self._reset()
+
+    def _spawn(self) -> tuple:
+        """ Start a pool and all its workers. """
+        pool = ProcessPoolExecutor(max_workers=self.max_workers, **self._kwargs)
+        # Submitted at once, so that each of them starts its own worker
+        futures = [pool.submit(os.getpid) for _ in range(self.max_workers)]
+        return pool, futures
+
+    def _reset(self) -> None:
+        self._started = time.monotonic()
+        self._tasks = 0
+        self._rss_checked = self._started
+
+    def warmed(self) -> list:
+        """ Futures done once every worker of the pool is initialized. """
+        return self._warming
+
+    def _recycle_reason(self) -> str | None:
+        now = time.monotonic()
+        if self.max_tasks and self._tasks >= self.max_tasks * self.max_workers:
+            return 'tasks'
+        if self.max_age and now - self._started >= self.max_age:
+            return 'age'
+        if self.max_rss and now - self._rss_checked >= _RSS_CHECK_INTERVAL:
+            self._rss_checked = now
+            pids = list(self._pool._processes or {})
+            if any(_rss(pid) > self.max_rss for pid in pids):
+                return 'rss'
+        return None
+
+    def _replace(self, reason: str) -> None:
+        """ Start a replacement pool, taking over once warmed up. """
+        log.info("replacing the process pool, reason: %s", reason)
+        POOL_RECYCLE_TOTAL.labels(reason).inc()
+        pool, futures = self._spawn()
+        self._next = pool
+        remaining = [len(futures)]
+
+        def warmed(future: Future) -> None:
+            with self._lock:
+                if self._next is not pool:
+                    return
+                if future.cancelled() or future.exception() is not None:
+                    log.error("cannot start a replacement process pool")
+                    self._next = None
+                    self._reset()
+                    pool.shutdown(wait=False)
+                    return
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+                old, self._pool, self._next = self._pool, pool, None
+                self._warming = futures
+                self._reset()
+            old.shutdown(wait=False)
+
+        for future in futures:
+            future.add_done_callback(warmed)
+
+    def _warmed_up(self) -> bool:
+        return all(future.done() and not future.cancelled() and future.exception() is None
+                   for future in self._warming)
+
+    def _restart(self) -> None:
+        """ Replace the broken pool right away, there is nothing left to
+        finish in it. A pool that broke while warming up is kept, as its
+        replacement would most likely break the same way. """
+        if not self._warmed_up():
+            raise BrokenProcessPool("the process pool broke while starting")
+        log.error("the process pool is broken, restarting it")
+        POOL_RECYCLE_TOTAL.labels('broken').inc()
+        broken = self._pool
+        self._pool, self._warming = self._spawn()
+        self._reset()
+        broken.shutdown(wait=False)
+
+    def broken(self) -> bool:
+        """ Whether the pool cannot run tasks, even once restarted. """
+        with self._lock:
+            if not self._pool._broken:
+                return False
+            try:
+                self._restart()
+            except Exception:  # pylint: disable=broad-except
+                log.exception("cannot restart the process pool")
+                return True
+            return False
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        with self._lock:
+            self._tasks += 1
+            if self._pool._broken:
+                self._restart()
+            if self._next is None:
+                reason = self._recycle_reason()
+                if reason is not None:
+                    self._replace(reason)
+            try:
+                return self._pool.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                # Broke since it was checked
+                self._restart()
+                return self._pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, **kwargs) -> None:
+        with self._lock:
+            pools = [self._pool, self._next]
+            self._next = None
+        for pool in pools:
+            if pool is not None:
+                pool.shutdown(wait, **kwargs)
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import json
+import logging
+import time
+from typing import Awaitable, Callable
+
+from google.protobuf.json_format import ParseDict
+from prometheus_client import Counter, Gauge
+
+from .metrics import _REGISTRY
+from .protobuf.youtube_dl_tiny_grpc_pb2 import ExtractInfoRequest
+
+WARM_TOTAL = Counter('warm_total', 'Total number of requests extracted again to keep the cache warm, by outcome', ['outcome'], registry=_REGISTRY)
+WARM_WATCHED = Gauge('warm_watched', 'Number of requests kept warm', multiprocess_mode='livesum', registry=_REGISTRY)
+
+# Min number of seconds between two warmings of a request, so results that
+# cannot be cached for long do not keep the workers busy
+_MIN_INTERVAL = 60
+
+# Seconds before a failed warming is tried again
+_RETRY_INTERVAL = 60
+
+# Max number of requests kept warm
+_MAX_WATCHED = 1024
+
+log = logging.getLogger(__name__)
+
+
+class WarmerFull(Exception):
+    """ Too many requests are kept warm already. """
+
+
+def load_requests(path: str) -> list[ExtractInfoRequest]:
+    """ Read the requests to keep warm from a JSON file holding a list of
+    ExtractInfoRequest, eg: [{"url": "...", "options": {"playlistend": 5}}] """
+    with open(path) as f:
+        return [ParseDict(request, ExtractInfoRequest()) for request in json.load(f)]
+
+
+class Warmer(object):
+    """ Extracts the watched requests again before their cached results
+    expire, so live requests for them are served from the cache. At most
+    `concurrency` of them are extracted at once, leaving the rest of the
+    process pool to live requests. """
+
+    def __init__(self, concurrency: int, interval: float, lead: float):
+        self.concurrency = concurrency
+        # Max number of seconds between two warmings of a request
+        self.interval = interval
+        # Requests are warmed this many seconds before their results expire
+        self.lead = lead
+        # Serialized request -> request
+        self.watched: dict[bytes, ExtractInfoRequest] = {}
+        # (monotonic time, serialized request) of the next warmings
+        self._due: list[tuple[float, bytes]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def watch(self, requests: list[ExtractInfoRequest]) -> int:
+        """ Keep the given requests warm, the new ones being warmed right
+        away. Returns the number of requests kept warm. """
+        keys = [request.SerializeToString(deterministic=True) for request in requests]
+        new = {key: request for key, request in zip(keys, requests) if key not in self.watched}
+        if len(self.watched) + len(new) > _MAX_WATCHED:
+            raise WarmerFull(f"cannot keep more than {_MAX_WATCHED} requests warm")
+
+        now = time.monotonic()
+        for key, request in new.items():
+            self.watched[key] = request
+            heapq.heappush(self._due, (now, key))
+        WARM_WATCHED.set(len(self.watched))
+        self._wakeup.set()
+        return len(self.watched)
+
+    def start(self, warm: Callable[[ExtractInfoRequest, float], Awaitable[float | None]]) -> None:
+        """ Start warming the watched requests with the given coroutine,
+        which extracts a request into the cache, refreshing the results
+        expiring within the given lead, and returns how long its results
+        stay cached. """
+        self._task = asyncio.ensure_future(self._run(warm))
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self, warm: Callable[[ExtractInfoRequest, float], Awaitable[float | None]]) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks: set[asyncio.Task] = set()
+        try:
+            while True:
+                self._wakeup.clear()
+                while self._due and self._due[0][0] <= time.monotonic():
+                    _, key = heapq.heappop(self._due)
+                    await semaphore.acquire()
+                    task = asyncio.ensure_future(self._warm(warm, key))
+                    tasks.add(task)
+                    task.add_done_callback(lambda task: (tasks.discard(task), semaphore.release()))
+
+                timeout = self._due[0][0] - time.monotonic() if self._due else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _warm(self, warm: Callable[[ExtractInfoRequest, float], Awaitable[float | None]],
+                    key: bytes) -> None:
+        """ Warm a single request and schedule its next warming. """
+        try:
+            ttl = await warm(self.watched[key], self.lead)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning("cannot warm %s: %s", self.watched[key].url, e)
+            WARM_TOTAL.labels('failure').inc()
+            delay = min(_RETRY_INTERVAL, self.interval)
+        else:
+            WARM_TOTAL.labels('success').inc()
+            delay = self.interval
+            if ttl is not None:
+                delay = min(max(ttl - self.lead, _MIN_INTERVAL), delay)
+        heapq.heappush(self._due, (time.monotonic() + delay, key))
+        self._wakeup.set()
@@ -1,112 +1,1198 @@
 from __future__ import annotations
 import asyncio
+import base64
+import functools
 import json
 import logging
+import os
 import random
+import re
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable
+from urllib.parse import urlsplit
 
-from google.protobuf.json_format import MessageToDict, ParseDict
-from prometheus_client import Counter
+from google.protobuf.json_format import MessageToDict
+from prometheus_client import Counter, Histogram
 
 import grpc
 from youtube_dl import YoutubeDL
+from youtube_dl.compat import compat_http_client, compat_HTTPError, \
+    compat_urllib_error
+from youtube_dl.extractor import gen_extractor_classes, get_info_extractor
+from youtube_dl.utils import DownloadError, ExtractorError, \
+    GeoRestrictedError, UnsupportedError, bug_reports_message
 
-from .cache import Cache, gen_key
-from .protobuf.youtube_dl_tiny_grpc_pb2 import ExtractInfoRequest, ExtractInfoResponse
+from .admission import REJECTED_TOTAL, AdmissionQueue, Call, QueueFull
+from .cache import Cache, MemoryCache, SqliteCache, gen_key
+from .health import LOAD_REPORT_KEY
+from .hedging import HEDGE_TOTAL, HEDGE_WON_TOTAL, Hedging
+from .limits import SiteLimiter
+from .proxy import ProxyManager
+from .protobuf.youtube_dl_tiny_grpc_pb2 import BatchExtractInfoRequest, \
+    BatchExtractInfoResponse, ExtractInfoRequest, ExtractInfoResponse, \
+    LoadReport, WarmRequest, WarmResponse
 from .protobuf.youtube_dl_tiny_grpc_pb2_grpc import (
     YoutubeDLServicer as YoutubeDLServerBase,
 )
-from .util import ProcessPoolExecutor
+from .responses import Extraction, entry_ref, extraction, \
+    frame_batch_response, is_error, is_index, is_listing, pack, pack_error, \
+    pack_index, pack_listing, receive, serialize_info, unpack, unpack_error, \
+    unpack_index, unpack_listing, url_expiry, valid_fields
+from .util import RecyclingProcessPool
+from .warmer import Warmer, WarmerFull
 
 from .metrics import _REGISTRY
 
 REQUEST_TOTAL = Counter('request_total', 'Total number of requests', registry=_REGISTRY)
-CACHE_HIT_TOTAL = Counter('cache_hit_total', 'Total number of cache hits', registry=_REGISTRY)
-CACHE_MISS_TOTAL = Counter('cache_miss_total', 'Total number of cache misses', registry=_REGISTRY)
+CACHE_HIT_TOTAL = Counter('cache_hit_total', 'Total number of cache hits', ['tier'], registry=_REGISTRY)
+CACHE_MISS_TOTAL = Counter('cache_miss_total', 'Total number of cache misses', ['tier'], registry=_REGISTRY)
+COALESCED_TOTAL = Counter('coalesced_total', 'Total number of requests coalesced into an in-flight extraction', registry=_REGISTRY)
+REFRESH_TOTAL = Counter('refresh_total', 'Total number of cache entries refreshed in the background', registry=_REGISTRY)
+REQUEST_SECONDS = Histogram('request_seconds', 'Time spent answering requests, by cache outcome or else by status code of the failure, cancelled ones included', ['outcome'], registry=_REGISTRY)
+EXTRACTION_SECONDS = Histogram('extraction_seconds', 'Time spent extracting info in the process pool, by extractor', ['extractor'], registry=_REGISTRY)
+SERIALIZATION_SECONDS = Histogram('serialization_seconds', 'Time spent serializing responses, by extractor', ['extractor'], registry=_REGISTRY)
+RETRY_TOTAL = Counter('extraction_retry_total', 'Total number of extraction attempts retried', registry=_REGISTRY)
+FAILURE_TOTAL = Counter('extraction_failure_total', 'Total number of failed extractions, by gRPC status', ['code'], registry=_REGISTRY)
+NEGATIVE_HIT_TOTAL = Counter('cache_negative_hit_total', 'Total number of requests answered with a cached failure, by gRPC status', ['code'], registry=_REGISTRY)
 
 # Offload all youtube_dl processing to a separate process in this pool
 # Idea from https://github.com/grpc/grpc/issues/16001
-_YOUTUBE_DL_PROCESS_POOL: ProcessPoolExecutor | None = None
+_YOUTUBE_DL_PROCESS_POOL: RecyclingProcessPool | None = None
 
 # Default options for youtube-dl itself
 _YOUTUBE_DL_DEFAULT_OPTS = {}
 
 # The cache ssot
-_YOUTUBE_DL_CACHE: Cache | None = None
+_YOUTUBE_DL_CACHE: Cache | SqliteCache | None = None
 
-# List of proxies to use in youtube-dl
-_YOUTUBE_DL_PROXY_LIST: list | None = None
+# In-process cache tier in front of _YOUTUBE_DL_CACHE
+_YOUTUBE_DL_MEMORY_CACHE: MemoryCache | None = None
+
+# Proxies to use in youtube-dl
+_YOUTUBE_DL_PROXIES: ProxyManager | None = None
+
+# Extractions failing with a retryable error are tried this many more
+# times, after a random delay of up to _RETRY_BACKOFF * 2 ** attempt seconds
+_RETRIES = 5
+_RETRY_BACKOFF = 0.5
+_MAX_RETRY_BACKOFF = 8
+
+# Failures that extracting again would not fix, cached for
+# _YOUTUBE_DL_NEGATIVE_TTL seconds
+_PERMANENT_CODES = ('NOT_FOUND', 'PERMISSION_DENIED', 'INVALID_ARGUMENT')
+_YOUTUBE_DL_NEGATIVE_TTL: float = 0
+
+# Expected youtube-dl errors about videos that exist but cannot be watched
+_DENIED = re.compile(r'\bprivate\b|sign in|log ?in\b|members[- ]only|confirm your age', re.IGNORECASE)
+
+# Socket timeout of youtube-dl when going through a proxy
+_PROXY_TIMEOUT = 30
+
+# Bounds the jobs waiting for _YOUTUBE_DL_PROCESS_POOL
+_YOUTUBE_DL_ADMISSION: AdmissionQueue | None = None
+
+# Rate limits and caps the extractions of each site, before they reach
+# _YOUTUBE_DL_ADMISSION
+_YOUTUBE_DL_LIMITER: SiteLimiter | None = None
+
+# Tells when a slow extraction attempt gets a second one
+_YOUTUBE_DL_HEDGING: Hedging | None = None
+
+# Call being served, admitted as a whole by _YOUTUBE_DL_ADMISSION. Inherited
+# by the tasks it starts, eg: the extractions of the entries of a playlist.
+_CALL: ContextVar[Call | None] = ContextVar('call', default=None)
+
+# Max extractions of a single call waiting or running at once, and max
+# requests of a single BatchExtractInfo or StreamExtractInfo handled at once
+_CALL_CONCURRENCY = 16
+
+# Moving average of the share of requests answered from the cache, reported
+# to the load balancers along with the load of the process pool
+_CACHE_HIT_RATE: float | None = None
+_HIT_RATE_ALPHA = 0.05
+
+# Extractions currently running in the process pool, by cache key.
+# Concurrent requests for the same key await the same task instead of
+# submitting a duplicate job to the pool.
+_IN_FLIGHT: dict[str, asyncio.Task] = {}
+
+# Number of callers still waiting on each shared task or future. Those are
+# cancelled once all their callers went away, see YoutubeDLServer._hold.
+_CALLERS: dict[asyncio.Future, int] = {}
+
+# Options only selecting which entries of a playlist are extracted, left
+# out of the cache key of the entries themselves
+_PLAYLIST_OPTS = ('playlistend', 'playliststart')
+
+# Trailer of ExtractInfo holding the token of the next page of a playlist
+_NEXT_PAGE_TOKEN_KEY = 'next-page-token'
+
+# Cache entries expiring within this many seconds are served and
+# refreshed in the background
+_YOUTUBE_DL_REFRESH_WINDOW: float = 0
+
+# Entries holding signed media urls are dropped from the cache this many
+# seconds before the urls expire, leaving clients some time to use them
+_EXPIRY_MARGIN = 60
+
+# youtube-dl extractors, used to tell the id of a video from its url
+_YOUTUBE_DL_EXTRACTORS: list | None = None
+
+# Ready to use YoutubeDL instances of a pool worker, by their options.
+# Only ever populated inside the worker processes, see init_worker.
+_YOUTUBE_DL_INSTANCES: OrderedDict[str, YoutubeDL] = OrderedDict()
+_YOUTUBE_DL_INSTANCES_SIZE = 0
+
+# Class of the YoutubeDL instances of a pool worker, replaced by a stand-in
+# in benchmarks
+_YOUTUBE_DL_CLASS: type = YoutubeDL
 
 log = logging.getLogger(__name__)
 
 
 def configure(
         default_opts: dict,
-        process_pool: ProcessPoolExecutor,
-        cache: Cache | None,
-        proxy_list) -> None:
+        process_pool: RecyclingProcessPool,
+        cache: Cache | SqliteCache | None,
+        proxies: ProxyManager | None,
+        memory_cache: MemoryCache | None = None,
+        refresh_window: float = 0,
+        admission: AdmissionQueue | None = None,
+        negative_ttl: float = 0,
+        limiter: SiteLimiter | None = None,
+        hedging: Hedging | None = None,
+        call_concurrency: int = 16) -> None:
     global _YOUTUBE_DL_DEFAULT_OPTS
     global _YOUTUBE_DL_PROCESS_POOL
-    global _YOUTUBE_DL_PROXY_LIST
+    global _YOUTUBE_DL_PROXIES
     global _YOUTUBE_DL_CACHE
+    global _YOUTUBE_DL_MEMORY_CACHE
+    global _YOUTUBE_DL_REFRESH_WINDOW
+    global _YOUTUBE_DL_ADMISSION
+    global _YOUTUBE_DL_NEGATIVE_TTL
+    global _YOUTUBE_DL_LIMITER
+    global _YOUTUBE_DL_HEDGING
+    global _CALL_CONCURRENCY
     _YOUTUBE_DL_DEFAULT_OPTS = default_opts
     _YOUTUBE_DL_PROCESS_POOL = process_pool
-    _YOUTUBE_DL_PROXY_LIST = proxy_list
+    _YOUTUBE_DL_PROXIES = proxies
     _YOUTUBE_DL_CACHE = cache
+    _YOUTUBE_DL_MEMORY_CACHE = memory_cache
+    _YOUTUBE_DL_REFRESH_WINDOW = refresh_window
+    _YOUTUBE_DL_ADMISSION = admission
+    _YOUTUBE_DL_NEGATIVE_TTL = negative_ttl
+    _YOUTUBE_DL_LIMITER = limiter
+    _YOUTUBE_DL_HEDGING = hedging
+    _CALL_CONCURRENCY = call_concurrency
+
+
+def init_worker(instances_size: int, youtube_dl_class: type | None = None,
+                default_opts: dict | None = None) -> None:
+    """Initializer of the process pool workers. Given the default options,
+    it warms the worker up so its first extraction is not slower than the
+    next ones: a youtube-dl instance is built and every extractor gets its
+    regexes compiled."""
+    global _YOUTUBE_DL_INSTANCES_SIZE
+    global _YOUTUBE_DL_CLASS
+    _YOUTUBE_DL_INSTANCES_SIZE = instances_size
+    _YOUTUBE_DL_CLASS = youtube_dl_class or YoutubeDL
+    _YOUTUBE_DL_INSTANCES.clear()
+    if default_opts is not None:
+        _get_youtube_dl(default_opts)
+        for ie in gen_extractor_classes():
+            ie.suitable('')
+
+
+def _get_youtube_dl(opts: dict) -> YoutubeDL:
+    """Return a YoutubeDL instance for the given options, reusing one
+    built by a previous call of this worker whenever possible."""
+    key = json.dumps(opts, sort_keys=True)
+    ydl = _YOUTUBE_DL_INSTANCES.get(key)
+    if ydl is not None:
+        _YOUTUBE_DL_INSTANCES.move_to_end(key)
+        return ydl
+
+    ydl = _YOUTUBE_DL_CLASS(opts)
+    if _YOUTUBE_DL_INSTANCES_SIZE > 0:
+        _YOUTUBE_DL_INSTANCES[key] = ydl
+        while len(_YOUTUBE_DL_INSTANCES) > _YOUTUBE_DL_INSTANCES_SIZE:
+            _YOUTUBE_DL_INSTANCES.popitem(last=False)
+    return ydl
+
+
+def _retryable(e: BaseException) -> bool:
+    """Whether an extraction failing with the given error may succeed when
+    tried again, possibly through another proxy."""
+    if isinstance(e, DownloadError) and e.exc_info is not None:
+        e = e.exc_info[1]
+    if isinstance(e, GeoRestrictedError):
+        return True
+    if isinstance(e, ExtractorError):
+        cause = e.cause or (e.exc_info[1] if e.exc_info else None)
+        if cause is None:
+            # Only unexpected errors, eg: a page served to a banned proxy not
+            # matching, ask for a bug report. Expected ones are the likes of
+            # unavailable videos.
+            return bug_reports_message() in str(e)
+        e = cause
+    if isinstance(e, compat_HTTPError):
+        return e.code in (403, 429) or e.code >= 500
+    return isinstance(e, (compat_urllib_error.URLError,
+                          compat_http_client.HTTPException, OSError))
+
+
+def _status(e: BaseException, retryable: bool) -> str:
+    """Name of the gRPC status of an extraction failing with the given
+    error, once it was tried as many times as it could be."""
+    if isinstance(e, DownloadError) and e.exc_info is not None:
+        e = e.exc_info[1]
+    if isinstance(e, GeoRestrictedError):
+        return 'PERMISSION_DENIED'
+    if isinstance(e, UnsupportedError):
+        return 'INVALID_ARGUMENT'
+    if retryable:
+        return 'UNAVAILABLE'
+    if isinstance(e, ExtractorError) and bug_reports_message() not in str(e):
+        # Expected errors: private, removed or unavailable videos
+        return 'PERMISSION_DENIED' if _DENIED.search(str(e)) else 'NOT_FOUND'
+    return 'INTERNAL'
+
+
+def _cached_failure(content: bytes) -> ExtractInfoError:
+    """Error to answer a request whose failure is cached with."""
+    code, message = unpack_error(content)
+    NEGATIVE_HIT_TOTAL.labels(code).inc()
+    return ExtractInfoError(grpc.StatusCode[code], message)
+
+
+def _timed(fn: Callable, *args) -> tuple[Any, float]:
+    """Run the given function, returning its result and how long it took."""
+    start = time.monotonic()
+    result = fn(*args)
+    return result, time.monotonic() - start
+
+
+def _extractor(info: dict) -> str:
+    """Metric label of the extractor of the given info dict."""
+    return info.get('extractor_key') or info.get('ie_key') or 'unknown'
+
+
+def _serialize(info: dict, fields: list[str]) -> list[bytes]:
+    """Same as serialize_info, timed."""
+    with SERIALIZATION_SECONDS.labels(_extractor(info)).time():
+        return serialize_info(info, fields)
+
+
+def _entry_opts(opts: dict) -> dict:
+    """Options affecting the extraction of a single video."""
+    return {k: v for k, v in opts.items() if k not in _PLAYLIST_OPTS}
+
+
+def _ttl(expiry: int | None) -> float | None:
+    """Seconds a video can be cached for, bounded by the given expiry of
+    its signed media urls, if any."""
+    if expiry is None:
+        return None
+    return max(expiry - time.time() - _EXPIRY_MARGIN, 0)
+
+
+def _needs_refresh(ttl: float | None, window: float = 0) -> bool:
+    """Whether a cache entry expiring in ttl seconds should be refreshed,
+    within the given window too if any."""
+    return ttl is not None and ttl < max(_YOUTUBE_DL_REFRESH_WINDOW, window)
+
+
+def _log_exception(task: asyncio.Task) -> None:
+    """Log the exception of a background task nobody awaits."""
+    if not task.cancelled() and task.exception() is not None:
+        log.error("background task failed", exc_info=task.exception())
+
+
+def _extractors() -> list:
+    global _YOUTUBE_DL_EXTRACTORS
+    if _YOUTUBE_DL_EXTRACTORS is None:
+        _YOUTUBE_DL_EXTRACTORS = [
+            ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic'
+        ]
+    return _YOUTUBE_DL_EXTRACTORS
+
+
+@functools.lru_cache(maxsize=4096)
+def _match_extractor(url: str) -> type | None:
+    """Return the extractor youtube-dl would extract the given url with,
+    unless it is the generic one."""
+    for ie in _extractors():
+        if ie.suitable(url):
+            return ie
+    return None
+
+
+def _match_entry(url: str) -> tuple[str, str] | None:
+    """Return the (extractor, id) of the given url, as youtube-dl would
+    extract it, without extracting it."""
+    ie = _match_extractor(url)
+    if ie is None:
+        return None
+    try:
+        return ie.ie_key(), ie._match_id(url)
+    except Exception:  # pylint: disable=broad-except
+        # Not every extractor has an id in its url
+        return None
+
+
+def _site(url: str, ie_key: str | None = None) -> tuple[list[str], str]:
+    """Return the names of the extractor of the given url, if known, and
+    its host, for the site limits."""
+    try:
+        ie = _match_extractor(url) if ie_key is None else get_info_extractor(ie_key)
+    except KeyError:
+        ie = None
+    names = []
+    if ie is not None:
+        names.append(ie.ie_key())
+        if isinstance(ie.IE_NAME, str):
+            names.append(ie.IE_NAME)
+    return names, urlsplit(url).hostname or ''
+
+
+def _serialize_response(response: ExtractInfoResponse | bytes) -> bytes:
+    """Responses read from the cache are already serialized."""
+    if isinstance(response, bytes):
+        return response
+    return response.SerializeToString()
+
+
+def add_to_server(servicer: YoutubeDLServer, server: grpc.aio.Server) -> None:
+    """Same as the generated add_YoutubeDLServicer_to_server but allows the
+    servicer to stream already serialized responses."""
+    rpc_method_handlers = {
+        'ExtractInfo': grpc.unary_stream_rpc_method_handler(
+            servicer.ExtractInfo,
+            request_deserializer=ExtractInfoRequest.FromString,
+            response_serializer=_serialize_response,
+        ),
+        'BatchExtractInfo': grpc.unary_stream_rpc_method_handler(
+            servicer.BatchExtractInfo,
+            request_deserializer=BatchExtractInfoRequest.FromString,
+            response_serializer=_serialize_response,
+        ),
+        'StreamExtractInfo': grpc.stream_stream_rpc_method_handler(
+            servicer.StreamExtractInfo,
+            request_deserializer=ExtractInfoRequest.FromString,
+            response_serializer=_serialize_response,
+        ),
+        'Warm': grpc.unary_unary_rpc_method_handler(
+            servicer.Warm,
+            request_deserializer=WarmRequest.FromString,
+            response_serializer=_serialize_response,
+        ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+        'YoutubeDL', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+
+
+def _deadline(context: grpc.aio.ServicerContext) -> float | None:
+    """Monotonic time by which the call has to be answered, if any."""
+    remaining = context.time_remaining()
+    if remaining is None:
+        return None
+    return time.monotonic() + remaining
+
+
+async def _within(aw: Awaitable, deadline: float | None) -> Any:
+    """Await the given awaitable, cancelling it when the deadline passes."""
+    if deadline is None:
+        return await aw
+
+    future = asyncio.ensure_future(aw)
+    try:
+        done, _ = await asyncio.wait(
+            [future], timeout=max(deadline - time.monotonic(), 0))
+    finally:
+        if not future.done():
+            future.cancel()
+    if not done:
+        raise ExtractInfoError(grpc.StatusCode.DEADLINE_EXCEEDED,
+                               "deadline exceeded while extracting info")
+    return future.result()
+
+
+def _page_token(listing_key: str, start: int, last_id: str) -> str:
+    """Opaque token of the page starting at the given position of a
+    listing, right after the video of the given id."""
+    return base64.urlsafe_b64encode(
+        json.dumps([listing_key[:16], start, last_id]).encode()).decode()
+
+
+def _parse_page_token(token: str, listing_key: str) -> tuple[int, str]:
+    """Return the position the page of the given token starts at, and the
+    id of the video right before it."""
+    try:
+        check, start, last_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (TypeError, ValueError):
+        check, start, last_id = None, 0, None
+    if check != listing_key[:16] or not isinstance(start, int) or start < 2:
+        raise ExtractInfoError(grpc.StatusCode.INVALID_ARGUMENT,
+                               "invalid page token")
+    return start, last_id
+
+
+def _observe_hit(hit: bool) -> None:
+    global _CACHE_HIT_RATE
+    if _CACHE_HIT_RATE is None:
+        _CACHE_HIT_RATE = float(hit)
+    else:
+        _CACHE_HIT_RATE += _HIT_RATE_ALPHA * (hit - _CACHE_HIT_RATE)
+
+
+def _check_wait(deadline: float | None) -> None:
+    """Fail fast when the deadline would pass before a worker is free."""
+    if deadline is None or _YOUTUBE_DL_ADMISSION is None:
+        return
+    if time.monotonic() + _YOUTUBE_DL_ADMISSION.expected_wait() > deadline:
+        REJECTED_TOTAL.labels('deadline').inc()
+        raise ExtractInfoError(grpc.StatusCode.DEADLINE_EXCEEDED,
+                               "deadline exceeded waiting for a worker")
+
+
+async def _aiter(items: list) -> AsyncIterator:
+    """Iterate over a list asynchronously."""
+    for item in items:
+        yield item
+
+
+async def warm_up() -> None:
+    """Wait for the pool workers to be ready, compiling the regexes used
+    to match the entries of playlists in the meantime."""
+    _match_entry('')
+    if _YOUTUBE_DL_PROCESS_POOL is not None:
+        await asyncio.gather(*[
+            asyncio.wrap_future(future) for future in _YOUTUBE_DL_PROCESS_POOL.warmed()
+        ])
+
+
+def serving() -> bool:
+    """Whether the server can take more requests: the process pool runs,
+    restarted if need be, and extractions are not rejected for want of a
+    worker. The shared cache being skipped is only reported in the load,
+    as it is skipped by every server alike."""
+    if isinstance(_YOUTUBE_DL_PROCESS_POOL, RecyclingProcessPool) and \
+            _YOUTUBE_DL_PROCESS_POOL.broken():
+        return False
+    return _YOUTUBE_DL_ADMISSION is None or \
+        _YOUTUBE_DL_ADMISSION.queued < _YOUTUBE_DL_ADMISSION.max_queue
+
+
+def load_report() -> LoadReport:
+    """Current load of the server, for weighted load balancing."""
+    report = LoadReport(cpu_utilization=os.getloadavg()[0] / (os.cpu_count() or 1))
+    if _YOUTUBE_DL_ADMISSION is not None:
+        admission = _YOUTUBE_DL_ADMISSION
+        report.application_utilization = (admission.running + admission.queued) / admission.slots
+        report.named_metrics['queue_depth'] = admission.queued
+        report.named_metrics['busy_workers'] = admission.running
+        report.named_metrics['workers'] = admission.slots
+    if _CACHE_HIT_RATE is not None:
+        report.named_metrics['cache_hit_rate'] = _CACHE_HIT_RATE
+    if _YOUTUBE_DL_CACHE is not None:
+        report.named_metrics['cache_available'] = _YOUTUBE_DL_CACHE.is_available()
+    return report
+
+
+def _report_load(context: grpc.aio.ServicerContext, trailers: list = []) -> None:
+    """Send the current load in the trailers of the call, along with the
+    given ones."""
+    context.set_trailing_metadata((
+        (LOAD_REPORT_KEY, load_report().SerializeToString()),
+        *trailers,
+    ))
 
 
 def shutdown_pool() -> None:
     global _YOUTUBE_DL_PROCESS_POOL
-    if isinstance(_YOUTUBE_DL_PROCESS_POOL, ProcessPoolExecutor):
+    if isinstance(_YOUTUBE_DL_PROCESS_POOL, RecyclingProcessPool):
         log.info("stopping process pool")
         _YOUTUBE_DL_PROCESS_POOL.shutdown(False)
     else:
         log.warning("cannot stop a non existent process pool")
 
 
+class ExtractionError(Exception):
+    """An extraction failed in a pool worker. Only holds the message of
+    the youtube-dl error so it can be sent back to the server process,
+    along with the name of the gRPC status to answer with."""
+
+    def __init__(self, message: str, retryable: bool, code: str = 'INTERNAL'):
+        super().__init__(message, retryable, code)
+        self.message = message
+        self.retryable = retryable
+        self.code = code
+
+    def __str__(self) -> str:
+        return self.message
+
+
+class ExtractInfoError(Exception):
+    """A request failed with the given gRPC status."""
+
+    def __init__(self, code: grpc.StatusCode, details: str):
+        super().__init__(details)
+        self.code = code
+        self.details = details
+
+
 class YoutubeDLServer(YoutubeDLServerBase):
     """Provides methods that implement functionality of YoutubeDL server."""
 
-    def __init__(self):
+    def __init__(self, warmer: Warmer | None = None):
         self.cache = _YOUTUBE_DL_CACHE
+        self.memory_cache = _YOUTUBE_DL_MEMORY_CACHE
+        self.warmer = warmer
+
+    async def _cache_get(self, key: str) -> tuple[bytes | None, float | None]:
+        """Look the key up in the memory tier first, then in redis or sqlite.
+        Returns the content and its remaining TTL."""
+        if self.memory_cache is not None:
+            cached_ok, ttl = await self.memory_cache.get_with_ttl(key)
+            if cached_ok:
+                CACHE_HIT_TOTAL.labels('memory').inc()
+                return cached_ok, ttl
+            CACHE_MISS_TOTAL.labels('memory').inc()
+
+        if self.cache is not None:
+            cached_ok, ttl = await self.cache.get_with_ttl(key)
+            if cached_ok:
+                CACHE_HIT_TOTAL.labels(self.cache.name).inc()
+                if self.memory_cache is not None:
+                    await self.memory_cache.set(key, cached_ok, ttl)
+                return cached_ok, ttl
+            CACHE_MISS_TOTAL.labels(self.cache.name).inc()
+
+        return None, None
+
+    async def _cache_get_many(self, keys: list[str]) -> list[tuple[bytes | None, float | None]]:
+        """Look many keys up at once, redis or sqlite lookups sharing a
+        round trip."""
+        return await asyncio.gather(*[self._cache_get(key) for key in keys])
+
+    async def _cache_set(self, key: str, content: bytes, ttl: float | None = None) -> None:
+        """Store the content in every configured cache tier, for no longer
+        than the given ttl if any."""
+        if ttl is None and self.cache is not None:
+            # So the memory tier knows when the cache expires the content
+            ttl = self.cache.ttl
+        if self.memory_cache is not None:
+            await self.memory_cache.set(key, content, ttl)
+        if self.cache is not None:
+            await self.cache.set(key, content, ttl)
 
     @staticmethod
     def _extract_info(
             url: str,
             opts: dict = {},
-            retries: int = 0,
-            proxy: list = [],
-            proxy_timeout: int = 30) -> dict:
-        """Wrapper around youtube-dl's extract_info method
-        to handle retries with proxy rotation."""
-        count = retries
-        real_ydl_opts = opts
+            proxy: str | None = None,
+            proxy_timeout: int = 30,
+            ie_key: str | None = None) -> dict:
+        """Wrapper around youtube-dl's extract_info method going through
+        the given proxy. Errors are raised as ExtractionError, retries are
+        up to the caller."""
+        # Copied as the options end up owned by a cached YoutubeDL instance
+        real_ydl_opts = dict(opts)
 
         if proxy:
-            r_proxy = random.choice(proxy)
-            real_ydl_opts['proxy'] = r_proxy
+            real_ydl_opts['proxy'] = proxy
             real_ydl_opts['socket_timeout'] = proxy_timeout
 
         try:
-            ydl = YoutubeDL(real_ydl_opts)
-            info = ydl.extract_info(url, False)
+            ydl = _get_youtube_dl(real_ydl_opts)
+            info = ydl.extract_info(url, False, ie_key)
             return info
         except Exception as e:
-            if count <= 0:
-                raise e
-            count = count - 1
-            return YoutubeDLServer._extract_info(url, opts, count, proxy,
-                                                 proxy_timeout)
+            retryable = _retryable(e)
+            raise ExtractionError(str(e), retryable, _status(e, retryable)) from None
 
-    async def ExtractInfo(
-            self,
-            request: ExtractInfoRequest,
-            context: grpc.aio.ServicerContext
-    ) -> ExtractInfoResponse:
-        if request.url == "" or not isinstance(request.url, str):
-            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
-                                "invalid URL")
+    @staticmethod
+    def _extract_responses(
+            url: str,
+            opts: dict = {},
+            proxy: str | None = None,
+            proxy_timeout: int = 30,
+            ie_key: str | None = None,
+            fields: list[str] = []) -> Extraction:
+        """Same as _extract_info but builds the responses right away, only
+        sending them back serialized and packed."""
+        info = YoutubeDLServer._extract_info(url, opts, proxy, proxy_timeout,
+                                             ie_key)
+        return extraction(info, fields)
 
-        REQUEST_TOTAL.inc()
+    @staticmethod
+    def _extract_flat(
+            url: str,
+            opts: dict = {},
+            proxy: str | None = None,
+            proxy_timeout: int = 30,
+            fields: list[str] | None = None) -> dict | Extraction:
+        """List the entries of a playlist without resolving them, returns
+        the info dict of the playlist holding the list of its entries.
+        Given the fields of the responses, anything but a playlist is sent
+        back as its responses right away, as it is fully extracted."""
+        flat_opts = {**opts, 'extract_flat': 'in_playlist'}
+        info = YoutubeDLServer._extract_info(url, flat_opts, proxy,
+                                             proxy_timeout)
+        if fields is not None and 'entries' not in info:
+            return extraction(info, fields)
+        entries = list(info.get('entries') or [info])
+
+        # Same as channels returning their videos tab as the first entry
+        # when not flat, a reference to a playlist of the same extractor
+        # is listed in turn.
+        if entries and entries[0].get('_type') in ('url', 'url_transparent') and \
+                entries[0].get('ie_key') == info.get('extractor_key'):
+            info = YoutubeDLServer._extract_info(
+                entries[0]['url'], flat_opts, proxy, proxy_timeout,
+                entries[0]['ie_key'])
+            entries = list(info.get('entries') or [info])
+
+        return {**info, 'entries': entries}
+
+    @staticmethod
+    async def _submit(fn: Callable, *args, site: tuple[list[str], str]) -> tuple[Any, float]:
+        """Run the given function in the process pool once allowed by the
+        limits of its site and admitted, within the window of the current
+        call if any. Returns its result and how long it took."""
+        call = _CALL.get()
+        if call is None:
+            return await YoutubeDLServer._admit(fn, *args, site=site, call=None)
+        async with call.window:
+            return await YoutubeDLServer._admit(fn, *args, site=site, call=call)
+
+    @staticmethod
+    async def _admit(fn: Callable, *args, site: tuple[list[str], str],
+                     call: Call | None) -> tuple[Any, float]:
+        loop = asyncio.get_event_loop()
+        names, host = site
+        limit = _YOUTUBE_DL_LIMITER.limit(names, host) if _YOUTUBE_DL_LIMITER else None
+        release = await _YOUTUBE_DL_LIMITER.acquire(*limit, call) if limit else None
+        submitted = False
+
+        async def run() -> tuple[Any, float]:
+            try:
+                result, elapsed = await loop.run_in_executor(
+                    _YOUTUBE_DL_PROCESS_POOL, _timed, fn, *args)
+            finally:
+                if release is not None:
+                    release()
+            if isinstance(result, Extraction):
+                # Right away, not to leak shared memory if nobody awaits it
+                result = receive(result)
+            return result, elapsed
+
+        def submit() -> Awaitable[tuple[Any, float]]:
+            nonlocal submitted
+            submitted = True
+            return run()
+
+        try:
+            if _YOUTUBE_DL_ADMISSION is None:
+                return await asyncio.shield(submit())
+            return await _YOUTUBE_DL_ADMISSION.run(submit, names[0] if names else host, call)
+        finally:
+            if not submitted and release is not None:
+                release()
+
+    @staticmethod
+    async def _try(fn: Callable, url: str, opts: dict, proxy: str | None, *args,
+                   site: tuple[list[str], str]) -> tuple[Any, float]:
+        """Run a single attempt of the given extraction through the given
+        proxy, keeping track of the health of the proxy."""
+        start = time.monotonic()
+        try:
+            result, elapsed = await YoutubeDLServer._submit(
+                fn, url, opts, proxy, _PROXY_TIMEOUT, *args, site=site)
+        except ExtractionError as e:
+            if proxy is not None and e.retryable:
+                _YOUTUBE_DL_PROXIES.failure(proxy)
+            raise
+        if proxy is not None:
+            _YOUTUBE_DL_PROXIES.success(proxy, elapsed)
+        if _YOUTUBE_DL_HEDGING is not None:
+            # As seen by the caller, waiting for a worker included
+            _YOUTUBE_DL_HEDGING.observe(time.monotonic() - start)
+        return result, elapsed
+
+    @staticmethod
+    async def _hedge(fn: Callable, url: str, opts: dict, proxy: str | None,
+                     tried: list, *args, site: tuple[list[str], str]) -> tuple[Any, float]:
+        """Run an attempt of the given extraction, hedged by a second one
+        through another proxy once it is slower than most, if the budget
+        allows and a worker is free for it. The first successful one wins
+        and the other is cancelled, though its worker stays busy until it is
+        done; if both fail, the error of the first one is raised."""
+        def attempt(proxy: str | None) -> asyncio.Task:
+            return asyncio.ensure_future(YoutubeDLServer._try(
+                fn, url, opts, proxy, *args, site=site))
+
+        first = attempt(proxy)
+        delay = _YOUTUBE_DL_HEDGING.delay() if _YOUTUBE_DL_HEDGING else None
+        if delay is None:
+            return await first
+
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            idle = _YOUTUBE_DL_ADMISSION is None or _YOUTUBE_DL_ADMISSION.idle()
+            if not done and idle and _YOUTUBE_DL_HEDGING.spend():
+                hedge = _YOUTUBE_DL_PROXIES.pick(tried + [proxy]) if _YOUTUBE_DL_PROXIES else None
+                tried.append(hedge)
+                tasks.append(attempt(hedge))
+                HEDGE_TOTAL.inc()
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.exception() is None:
+                        if task is not first:
+                            HEDGE_WON_TOTAL.inc()
+                        return task.result()
+            return first.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # Retrieved so the losing one is not reported
+                    task.exception()
+
+    @staticmethod
+    async def _attempt(fn: Callable, url: str, opts: dict, *args,
+                       ie_key: str | None = None) -> Any:
+        """Run the given extraction in the process pool, through the best
+        proxy available. Retryable failures are tried again through another
+        proxy after a jittered delay."""
+        site = _site(url, ie_key)
+        tried = []
+        for attempt in range(_RETRIES + 1):
+            proxy = _YOUTUBE_DL_PROXIES.pick(tried) if _YOUTUBE_DL_PROXIES else None
+            try:
+                result, elapsed = await YoutubeDLServer._hedge(
+                    fn, url, opts, proxy, tried, *args, site=site)
+            except ExtractionError as e:
+                # Eg: a geo restriction, only worth retrying through
+                # another proxy
+                pointless = proxy is None and e.code in _PERMANENT_CODES
+                if not e.retryable or pointless or attempt == _RETRIES:
+                    FAILURE_TOTAL.labels(e.code).inc()
+                    raise
+                RETRY_TOTAL.inc()
+                tried.append(proxy)
+                await asyncio.sleep(random.uniform(
+                    0, min(_RETRY_BACKOFF * 2 ** attempt, _MAX_RETRY_BACKOFF)))
+                continue
+
+            if isinstance(result, Extraction):
+                SERIALIZATION_SECONDS.labels(result.extractor).observe(
+                    result.serialization_seconds)
+                elapsed -= result.serialization_seconds
+                EXTRACTION_SECONDS.labels(result.extractor).observe(elapsed)
+            else:
+                EXTRACTION_SECONDS.labels(_extractor(result)).observe(elapsed)
+            return result
+
+    @staticmethod
+    def _hold(future: asyncio.Future) -> asyncio.Future:
+        """Shield the given shared future for one more caller. It is
+        cancelled once all its callers went away before it is done, so
+        nothing is left waiting for a worker with nobody to answer."""
+        _CALLERS[future] = _CALLERS.get(future, 0) + 1
+        waiter = asyncio.shield(future)
+        waiter.add_done_callback(lambda _: YoutubeDLServer._release(future))
+        return waiter
+
+    @staticmethod
+    def _release(future: asyncio.Future) -> None:
+        """One caller of the shared future went away or got its result."""
+        _CALLERS[future] -= 1
+        if _CALLERS[future] == 0:
+            del _CALLERS[future]
+            if not future.done():
+                future.cancel()
+
+    @staticmethod
+    def _start(key: str, extract: Callable[[], Awaitable]) -> asyncio.Task:
+        """Run the given extraction as the in-flight one for the key."""
+        task = asyncio.ensure_future(extract())
+        _IN_FLIGHT[key] = task
+        task.add_done_callback(
+            lambda _: _IN_FLIGHT.pop(key) if _IN_FLIGHT.get(key) is task else None)
+        return task
+
+    @staticmethod
+    async def _coalesce(key: str, extract: Callable[[], Awaitable]) -> Any:
+        """Run the given extraction, sharing it between all concurrent
+        callers asking for the same key."""
+        task = _IN_FLIGHT.get(key)
+        if task is not None:
+            COALESCED_TOTAL.inc()
+        else:
+            task = YoutubeDLServer._start(key, extract)
+
+        return await YoutubeDLServer._hold(task)
+
+    @staticmethod
+    def _refresh(key: str, extract: Callable[[], Awaitable]) -> None:
+        """Run the given extraction in the background to refresh the cache,
+        unless the key is already being extracted."""
+        if key in _IN_FLIGHT:
+            return
+        REFRESH_TOTAL.inc()
+        task = YoutubeDLServer._start(key, extract)
+        task.add_done_callback(_log_exception)
+        # Held until done, even if the callers coalescing onto it go away
+        YoutubeDLServer._hold(task)
+
+    async def _extract_entries(self, key: str, url: str, opts: dict,
+                               fields: list[str]) -> list[bytes] | list[asyncio.Future]:
+        """Extract the info for the given url spreading its entries across
+        the process pool. Returns a future per entry, or the responses of
+        anything but a playlist."""
+        return await self._coalesce(
+            f"{key}:entries",
+            lambda: self._fan_out_and_store(key, url, opts, fields))
+
+    async def _entry_key(self, ref: tuple, opts: dict, fields: list[str]) -> str:
+        """Cache key of a single video, shared by every playlist it is in."""
+        return await gen_key(ref[0], ref[1], json.dumps(_entry_opts(opts)),
+                             *fields)
+
+    async def _store(self, key: str, result: Extraction, opts: dict,
+                     fields: list[str]) -> float | None:
+        """Cache every entry on its own and the request as the list of its
+        entries, or as a whole when some entry cannot be referenced.
+        Returns the TTL of the entry expiring first, if any."""
+        ttls = [_ttl(expiry) for expiry in result.expiries]
+        ttl = min((ttl for ttl in ttls if ttl is not None), default=None)
+        if any(ref is None for ref in result.refs):
+            await self._cache_set(key, pack(result.responses()), ttl)
+            return ttl
+
+        await self._store_each(result, opts, fields)
+        await self._cache_set(key, pack_index(result.refs))
+        return ttl
+
+    async def _store_each(self, result: Extraction, opts: dict, fields: list[str]) -> None:
+        """Cache every entry on its own, all of them having a reference."""
+        await asyncio.gather(*[
+            self._cache_set(await self._entry_key(ref, opts, fields), packed, _ttl(expiry))
+            for ref, packed, expiry in zip(result.refs, result.packed(), result.expiries)
+        ])
+
+    async def _store_failure(self, key: str | None, e: ExtractionError) -> None:
+        """Cache a failure that extracting again would not fix, so retries
+        of the clients are answered right away for a while."""
+        if key is not None and e.code in _PERMANENT_CODES and _YOUTUBE_DL_NEGATIVE_TTL > 0:
+            await self._cache_set(key, pack_error(e.code, e.message),
+                                  _YOUTUBE_DL_NEGATIVE_TTL)
+
+    async def _extract_and_store(self, key: str, url: str, opts: dict,
+                                 fields: list[str]) -> list[bytes]:
+        """Run the extraction in the process pool and store the serialized
+        responses in the cache."""
+        try:
+            result = await self._attempt(self._extract_responses, url, opts,
+                                         None, fields)
+        except ExtractionError as e:
+            await self._store_failure(key, e)
+            raise
+        await self._store(key, result, opts, fields)
+        return result.responses()
+
+    async def _fan_out_and_store(self, key: str, url: str, opts: dict,
+                                 fields: list[str], refresh_window: float = 0
+                                 ) -> list[bytes] | list[asyncio.Future]:
+        """List the entries of the url and submit each of them missing from
+        the cache to the process pool, refreshing the cached ones expiring
+        within the given window. The request is stored in the cache once
+        all the entries are extracted."""
+        try:
+            result = await self._attempt(self._extract_flat, url, opts, fields)
+        except ExtractionError as e:
+            await self._store_failure(key, e)
+            raise
+        if isinstance(result, Extraction):
+            await self._store(key, result, opts, fields)
+            return result.responses()
+        entries = result['entries']
+
+        futures = await self._resolve_entries(entries, opts, fields, refresh_window)
+        self._start(f"{key}:index", lambda: self._store_entries(key, entries, futures))
+        return futures
+
+    async def _resolve_entries(self, entries: list[dict], opts: dict, fields: list[str],
+                               refresh_window: float = 0) -> list[asyncio.Future]:
+        """Resolve every entry concurrently, returns a future per entry.
+        Entries are looked up in the cache all at once and only the missing
+        ones are extracted, the ones expiring within the given window being
+        refreshed in the background."""
+        refs = [entry_ref(entry) for entry in entries]
+        keys = await asyncio.gather(*[
+            self._entry_key(ref, opts, fields) for ref in refs if ref is not None
+        ])
+        cached = iter(await self._cache_get_many(keys))
+        keys = iter(keys)
+
+        loop = asyncio.get_event_loop()
+        futures = []
+        for entry, ref in zip(entries, refs):
+            key = next(keys) if ref is not None else None
+            cached_ok, ttl = next(cached) if ref is not None else (None, None)
+            if cached_ok and is_error(cached_ok):
+                future = loop.create_future()
+                future.set_exception(_cached_failure(cached_ok))
+            elif cached_ok:
+                future = loop.create_future()
+                future.set_result(unpack(cached_ok))
+                if _needs_refresh(ttl, refresh_window) and \
+                        entry.get('_type') in ('url', 'url_transparent'):
+                    self._refresh(key, self._refresh_entry(entry, opts, fields, key))
+            else:
+                future = asyncio.ensure_future(
+                    self._extract_entry(entry, opts, fields, key))
+            futures.append(future)
+        return futures
+
+    def _refresh_entry(self, entry: dict, opts: dict, fields: list[str],
+                       key: str) -> Callable[[], Awaitable]:
+        """Extraction refreshing a single cached entry."""
+        return lambda: self._extract_entry(entry, opts, fields, key)
+
+    async def _extract_entry(self, entry: dict, opts: dict, fields: list[str],
+                             key: str | None) -> list[bytes]:
+        """Extract a single entry of a playlist and cache it under the
+        given key."""
+        if entry.get('_type') not in ('url', 'url_transparent'):
+            # Already resolved by the playlist extractor
+            content = pack(_serialize(entry, fields))
+            expiry = url_expiry(entry)
+        else:
+            try:
+                result = await self._attempt(self._extract_responses, entry['url'],
+                                             opts, entry.get('ie_key'), fields,
+                                             ie_key=entry.get('ie_key'))
+            except ExtractionError as e:
+                await self._store_failure(key, e)
+                raise
+            packed = result.packed()
+            content = packed[0] if len(packed) == 1 else pack(result.responses())
+            expiry = min((e for e in result.expiries if e is not None), default=None)
+            if key is None and len(result.refs) == 1 and result.refs[0] is not None:
+                key = await self._entry_key(result.refs[0], opts, fields)
+
+        if key is not None:
+            await self._cache_set(key, content, _ttl(expiry))
+        return unpack(content)
+
+    async def _store_entries(self, key: str, entries: list[dict],
+                             futures: list[asyncio.Future]) -> None:
+        """Cache the request once all its entries are extracted."""
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        if any(isinstance(result, BaseException) for result in results):
+            return
+
+        refs = [entry_ref(entry) for entry in entries]
+        if any(ref is None for ref in refs):
+            # Could only be cached as a whole, not knowing when the media
+            # urls of the entries expire.
+            return
+
+        # Entries are already cached by _resolve_entries
+        await self._cache_set(key, pack_index(refs))
+
+    async def _cache_lookup(self, key: str, url: str, opts: dict,
+                            fields: list[str]) -> list[bytes] | list[asyncio.Future] | None:
+        """Look the request up in the cache. Cached playlists resolve into a
+        future per entry, only the entries missing from the cache being
+        extracted again."""
+        cached_ok, ttl = await self._cache_get(key)
+        if cached_ok is None:
+            # The url may be a video already extracted as part of another
+            # request.
+            match = _match_entry(url)
+            if match is None:
+                return None
+            entry_key = await self._entry_key(match, opts, fields)
+            cached_ok, ttl = await self._cache_get(entry_key)
+            if cached_ok is None:
+                return None
+            if is_error(cached_ok):
+                raise _cached_failure(cached_ok)
+            if _needs_refresh(ttl):
+                entry = {'_type': 'url', 'ie_key': match[0], 'id': match[1], 'url': url}
+                self._refresh(entry_key,
+                              self._refresh_entry(entry, opts, fields, entry_key))
+            return unpack(cached_ok)
+
+        if is_error(cached_ok):
+            raise _cached_failure(cached_ok)
+
+        if not is_index(cached_ok):
+            if _needs_refresh(ttl):
+                self._refresh(key, lambda: self._extract_and_store(key, url, opts, fields))
+            return unpack(cached_ok)
+
+        if _needs_refresh(ttl):
+            self._refresh(f"{key}:entries",
+                          lambda: self._fan_out_and_store(key, url, opts, fields))
+
+        return await self._resolve_entries([
+            {'_type': 'url', 'ie_key': extractor, 'id': video_id, 'url': url}
+            for extractor, video_id, url in unpack_index(cached_ok)
+        ], opts, fields)
+
+    async def _listing(self, key: str, url: str, opts: dict, end: int,
+                       fields: list[str]) -> tuple[list[tuple[str, str, str]], bool, bool]:
+        """Entry references of a playlist up to the given position, fewer
+        when the playlist is shorter, whether that is all of them and
+        whether they were cached. The cached listing is extended when it is
+        too short, twice as long at least so deep pages only list the
+        playlist again a few times."""
+        cached_ok, _ = await self._cache_get(key)
+        if cached_ok is not None and is_error(cached_ok):
+            raise _cached_failure(cached_ok)
+        if cached_ok is not None and is_listing(cached_ok):
+            refs, complete = unpack_listing(cached_ok)
+            if complete or len(refs) >= end:
+                return refs, complete, True
+            end = max(end, 2 * len(refs))
+
+        refs, complete = await self._coalesce(
+            f"{key}:listing", lambda: self._extract_listing(key, url, opts, end, fields))
+        return refs, complete, False
+
+    async def _extract_listing(self, key: str, url: str, opts: dict, end: int,
+                               fields: list[str]) -> tuple[list[tuple[str, str, str]], bool]:
+        """List the entries of a playlist up to the given position and
+        cache their references. Anything but a playlist is fully extracted
+        already, so it is cached as well and listed as a single entry."""
+        try:
+            result = await self._attempt(self._extract_flat, url,
+                                         {**opts, 'playlistend': end}, fields)
+        except ExtractionError as e:
+            await self._store_failure(key, e)
+            raise
+        if isinstance(result, Extraction):
+            refs, complete = result.refs, True
+        else:
+            refs = [entry_ref(entry) for entry in result['entries']]
+            complete = len(refs) < end
+        if any(ref is None for ref in refs):
+            raise ExtractInfoError(grpc.StatusCode.UNIMPLEMENTED,
+                                   "the entries of this playlist cannot be paged through")
+        if isinstance(result, Extraction):
+            await self._store_each(result, opts, fields)
+        await self._cache_set(key, pack_listing(refs, complete))
+        return refs, complete
+
+    async def _page(self, request: ExtractInfoRequest, opts: dict, fields: list[str],
+                    trailers: list) -> tuple[list[asyncio.Future], bool]:
+        """Resolve a page of the entries of a playlist, returns a future per
+        entry and whether its listing was cached. The token of the next
+        page, if any, is added to the given trailers."""
+        listing_opts = _entry_opts(opts)
+        key = await gen_key(request.url, json.dumps(listing_opts), 'listing')
+        start, last_id = opts.get('playliststart', 1), None
+        if request.page_token:
+            start, last_id = _parse_page_token(request.page_token, key)
+
+        def bounds(start: int) -> tuple[int, int]:
+            end = start + request.page_size - 1
+            return start, min(end, opts['playlistend']) if opts.get('playlistend') else end
+
+        start, end = bounds(start)
+        refs, complete, cached = await self._listing(key, request.url, listing_opts, end, fields)
+        ids = [ref[1] for ref in refs]
+        if last_id is not None and ids[start - 2:start - 1] != [last_id] and last_id in ids:
+            # Videos were added or removed since the previous page, resume
+            # right after its last one
+            start, end = bounds(ids.index(last_id) + 2)
+            refs, complete, _ = await self._listing(key, request.url, listing_opts, end, fields)
+
+        page = refs[start - 1:end]
+        last = start + len(page) - 1
+        more = last < len(refs) or not complete
+        if page and more and not (opts.get('playlistend') and last >= opts['playlistend']):
+            trailers.append((_NEXT_PAGE_TOKEN_KEY, _page_token(key, last + 1, page[-1][1])))
+
+        futures = await self._resolve_entries([
+            {'_type': 'url', 'ie_key': extractor, 'id': video_id, 'url': url}
+            for extractor, video_id, url in page
+        ], opts, fields)
+        return futures, cached
+
+    async def warm(self, request: ExtractInfoRequest, lead: float = 0) -> float | None:
+        """Extract the request again and cache it, whether it is cached or
+        not: a playlist is listed again and its entries missing from the
+        cache or expiring within the given lead are extracted. Returns how
+        long its results stay cached, if known."""
+        key, ydl_opts, fields = await self._parse(request)
+        # Shared with a live extraction of the request, if any
+        responses = await self._coalesce(
+            f"{key}:entries",
+            lambda: self._fan_out_and_store(key, request.url, ydl_opts, fields, lead))
+        if responses and not isinstance(responses[0], bytes):
+            await asyncio.gather(*[self._hold(future) for future in responses])
+            # Once the request and the entries refreshed in the background
+            # are cached
+            task = _IN_FLIGHT.get(f"{key}:index")
+            if task is not None:
+                await asyncio.shield(task)
+            await self._refreshed(key, ydl_opts, fields)
+        return self._cache_ttl(await self._cached_ttl(key, ydl_opts, fields))
+
+    async def _refreshed(self, key: str, opts: dict, fields: list[str]) -> None:
+        """Wait for the entries of a cached playlist being refreshed."""
+        cached_ok, _ = await self._cache_get(key)
+        if cached_ok is None or not is_index(cached_ok):
+            return
+        keys = await asyncio.gather(*[
+            self._entry_key(ref, opts, fields) for ref in unpack_index(cached_ok)
+        ])
+        # Failures are logged and the entries warmed again sooner
+        await asyncio.gather(*[
+            asyncio.shield(_IN_FLIGHT[entry_key]) for entry_key in keys
+            if entry_key in _IN_FLIGHT
+        ], return_exceptions=True)
+
+    async def _cached_ttl(self, key: str, opts: dict, fields: list[str]) -> float | None:
+        """Remaining TTL of the cached results of a request, the one of its
+        entry expiring first for a playlist."""
+        cached_ok, ttl = await self._cache_get(key)
+        if cached_ok is not None and is_index(cached_ok):
+            keys = await asyncio.gather(*[
+                self._entry_key(ref, opts, fields) for ref in unpack_index(cached_ok)
+            ])
+            ttls = [ttl for _, ttl in await self._cache_get_many(keys)]
+            ttl = min((ttl for ttl in ttls if ttl is not None), default=None)
+        return ttl
+
+    def _cache_ttl(self, ttl: float | None) -> float | None:
+        """How long results stored for the given TTL stay cached, if known.
+        Nothing outlives the cache TTL, memory being only a front tier when
+        redis or sqlite is used."""
+        cache = self.cache or self.memory_cache
+        if cache is not None:
+            ttl = min(ttl, cache.ttl) if ttl is not None else cache.ttl
+        return ttl
+
+    async def _parse(self, request: ExtractInfoRequest) -> tuple[str, dict, list[str]]:
+        """Validate the request, returns its cache key, its youtube-dl
+        options and the fields of its responses."""
+        if request.url == "" or not isinstance(request.url, str):
+            raise ExtractInfoError(grpc.StatusCode.INVALID_ARGUMENT,
+                                   "invalid URL")
 
         ydl_custom_opts = MessageToDict(
             request.options,
@@ -119,65 +1205,197 @@ class YoutubeDLServer(YoutubeDLServerBase):
             **ydl_custom_opts,
         }
 
-        info = None
-        if self.cache is not None:
-            cached_ok = await self.cache.get(
-                await gen_key(request.url, json.dumps(ydl_opts))
-            )
-            if cached_ok:
-                CACHE_HIT_TOTAL.inc()
-                info = json.loads(cached_ok)
+        fields = sorted(request.fields.paths)
+        if not valid_fields(fields):
+            raise ExtractInfoError(grpc.StatusCode.INVALID_ARGUMENT,
+                                   "invalid fields")
 
-        if info is None:
-            CACHE_MISS_TOTAL.inc()
-            real_ydl_opts = ydl_opts
+        if request.page_token and not request.page_size:
+            raise ExtractInfoError(grpc.StatusCode.INVALID_ARGUMENT,
+                                   "page_token without page_size")
 
-            loop = asyncio.get_event_loop()
-            try:
-                info = await loop.run_in_executor(
-                    _YOUTUBE_DL_PROCESS_POOL,
-                    self._extract_info,
-                    request.url,
-                    real_ydl_opts,
-                    5,
-                    _YOUTUBE_DL_PROXY_LIST)
-            except Exception as e:
-                log.exception(e)
-                await context.abort(
-                    grpc.StatusCode.INTERNAL,
-                    "unknown error occurred while extracting info",
-                )
-
-            json_info = json.dumps(info)
-
-            if self.cache is not None:
-                await self.cache.set(
-                    await gen_key(request.url, json.dumps(ydl_opts)),
-                    json_info
-                )
-
-            # FIXME: Yes, this is a hack.
-            # youtube_dl sometimes returns tuples for some repeated fields
-            # and ParseDict doesn't like that.
-            info = json.loads(json_info)
+        key = await gen_key(request.url, json.dumps(ydl_opts), *fields)
+        return key, ydl_opts, fields
 
+    async def _responses(self, request: ExtractInfoRequest,
+                         deadline: float | None = None,
+                         trailers: list | None = None) -> AsyncIterator[bytes]:
+        """Stream the serialized responses of a single request, failing once
+        the given deadline passes. Trailers of the call, if any, are added
+        to the given list, which paged requests require."""
+        REQUEST_TOTAL.inc()
+        start = time.monotonic()
+        # Until the responses are all sent, the caller may go away
+        outcome, failure = None, 'cancelled'
         try:
-            entries = info['entries'][0]['entries']
-            for entry in entries:
-                yield ParseDict(
-                    entry,
-                    ExtractInfoResponse(),
-                    ignore_unknown_fields=True)
-        except KeyError:
+            key, ydl_opts, fields = await self._parse(request)
+            # Either the serialized responses or a future per entry
+            # resolving to its serialized responses.
+            if request.page_size:
+                responses, cached = await _within(self._page(
+                    request, ydl_opts, fields, trailers), deadline)
+            else:
+                responses = await self._cache_lookup(key, request.url, ydl_opts, fields)
+                cached = responses is not None
+            outcome = 'hit' if cached else 'miss'
+            _observe_hit(cached)
+            if responses is None:
+                if f"{key}:entries" in _IN_FLIGHT:
+                    outcome = 'coalesced'
+                else:
+                    _check_wait(deadline)
+                responses = await _within(
+                    self._extract_entries(key, request.url, ydl_opts, fields),
+                    deadline)
+
+            if responses and isinstance(responses[0], bytes):
+                for response in responses:
+                    yield response
+            else:
+                held = [self._hold(future) for future in responses]
+                try:
+                    futures = held
+                    if request.stream_entries and not request.keep_order:
+                        futures = asyncio.as_completed(held)
+                    for future in futures:
+                        for response in await _within(future, deadline):
+                            yield response
+                finally:
+                    for future in held:
+                        future.cancel()
+            failure = None
+        except ExtractInfoError as e:
+            failure = e.code.name.lower()
+            raise
+        except ExtractionError as e:
+            failure = e.code.lower()
+            raise ExtractInfoError(grpc.StatusCode[e.code], e.message) from e
+        except QueueFull as e:
+            failure = 'resource_exhausted'
+            raise ExtractInfoError(
+                grpc.StatusCode.RESOURCE_EXHAUSTED,
+                "too many pending extractions, try again later",
+            ) from e
+        except Exception as e:
+            failure = 'internal'
+            log.exception(e)
+            raise ExtractInfoError(
+                grpc.StatusCode.INTERNAL,
+                "unknown error occurred while extracting info",
+            ) from e
+        finally:
+            REQUEST_SECONDS.labels(failure or outcome).observe(time.monotonic() - start)
+
+    async def _batch(self, requests: AsyncIterable[ExtractInfoRequest],
+                     deadline: float | None = None) -> AsyncIterator[bytes]:
+        """Run the requests concurrently, up to _CALL_CONCURRENCY at once,
+        streaming their serialized responses tagged with the index of their
+        request as they come. Requests stop being read while the responses
+        are not, so a slow reader holds them back."""
+        queue: asyncio.Queue = asyncio.Queue(_CALL_CONCURRENCY)
+        running = asyncio.Semaphore(_CALL_CONCURRENCY)
+        tasks: set[asyncio.Task] = set()
+
+        async def run(index: int, request: ExtractInfoRequest) -> None:
+            try:
+                if request.page_size:
+                    # Nowhere to send the token of the next page
+                    raise ExtractInfoError(grpc.StatusCode.INVALID_ARGUMENT,
+                                           "page_size is only supported by ExtractInfo")
+                async for response in self._responses(request, deadline):
+                    await queue.put(frame_batch_response(index, response))
+            except ExtractInfoError as e:
+                await queue.put(BatchExtractInfoResponse(
+                    index=index, code=e.code.value[0], error=e.details))
+            finally:
+                running.release()
+
+        async def feed() -> None:
             try:
-                entries = info['entries']
-                for entry in entries:
-                    yield ParseDict(
-                        entry,
-                        ExtractInfoResponse(),
-                        ignore_unknown_fields=True)
-            except KeyError:
-                yield ParseDict(
-                    info,
-                    ExtractInfoResponse(),
-                    ignore_unknown_fields=True)
+                index = 0
+                async for request in requests:
+                    await running.acquire()
+                    task = asyncio.ensure_future(run(index, request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    index += 1
+                await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                # Nobody reads the responses anymore
+                raise
+            except Exception:
+                await queue.put(None)
+                raise
+            await queue.put(None)
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while True:
+                response = await queue.get()
+                if response is None:
+                    break
+                yield response
+            await feeder
+        finally:
+            feeder.cancel()
+            for task in list(tasks):
+                task.cancel()
+
+    async def ExtractInfo(
+            self,
+            request: ExtractInfoRequest,
+            context: grpc.aio.ServicerContext
+    ) -> ExtractInfoResponse:
+        _CALL.set(Call(_CALL_CONCURRENCY))
+        trailers = []
+        try:
+            async for response in self._responses(request, _deadline(context),
+                                                  trailers):
+                yield response
+        except ExtractInfoError as e:
+            _report_load(context)
+            await context.abort(e.code, e.details)
+        _report_load(context, trailers)
+
+    async def BatchExtractInfo(
+            self,
+            request: BatchExtractInfoRequest,
+            context: grpc.aio.ServicerContext
+    ) -> BatchExtractInfoResponse:
+        _CALL.set(Call(_CALL_CONCURRENCY))
+        async for response in self._batch(_aiter(request.requests),
+                                          _deadline(context)):
+            yield response
+        _report_load(context)
+
+    async def StreamExtractInfo(
+            self,
+            request_iterator: AsyncIterable[ExtractInfoRequest],
+            context: grpc.aio.ServicerContext
+    ) -> BatchExtractInfoResponse:
+        _CALL.set(Call(_CALL_CONCURRENCY))
+        async for response in self._batch(request_iterator,
+                                          _deadline(context)):
+            yield response
+        _report_load(context)
+
+    async def Warm(
+            self,
+            request: WarmRequest,
+            context: grpc.aio.ServicerContext
+    ) -> WarmResponse:
+        if self.warmer is None:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION,
+                                "cache warming is disabled")
+        try:
+            for warm_request in request.requests:
+                await self._parse(warm_request)
+                if warm_request.page_size:
+                    raise ExtractInfoError(grpc.StatusCode.INVALID_ARGUMENT,
+                                           "pages cannot be kept warm")
+            watched = self.warmer.watch(list(request.requests))
+        except ExtractInfoError as e:
+            await context.abort(e.code, e.details)
+        except WarmerFull as e:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        return WarmResponse(watched=watched)
@@ -5,13 +5,23 @@ import signal
 
 import grpc
 
-from .protobuf.youtube_dl_tiny_grpc_pb2_grpc import \
-    add_YoutubeDLServicer_to_server as AddYoutubeDLServer
-from .util import ProcessPoolExecutor
-from .cache import Cache
+from .admission import AdmissionQueue
+from .health import HealthMonitor
+from .hedging import Hedging
+from .limits import SiteLimiter, parse_limits
+from .proxy import ProxyManager
+from .util import RecyclingProcessPool
+from .warmer import Warmer, load_requests
+from .cache import Cache, MemoryCache, SqliteCache
+from .compression import Compression
+from .protobuf.youtube_dl_tiny_grpc_pb2 import DESCRIPTOR
 from .youtube_dl_service import YoutubeDLServer, \
+    add_to_server as AddYoutubeDLServer, \
     configure as configure_youtube_dl_server, \
-    shutdown_pool as shutdown_youtube_dl_server
+    init_worker as init_youtube_dl_worker, \
+    serving as youtube_dl_server_serving, \
+    shutdown_pool as shutdown_youtube_dl_server, \
+    warm_up as warm_up_youtube_dl_server
 
 log = logging.getLogger(__name__)
 
@@ -45,44 +55,143 @@ class Server:
             base_youtube_dl_args['cookiefile'] = \
                 args['youtube_dl_cookies_file']
 
-        redis = None
+        compression = Compression(
+            args['cache_compression'] if "cache_compression" in args else "gzip",
+            args['cache_compression_level'] if "cache_compression_level" in args else 0,
+            args['cache_zstd_dictionary_size'] if "cache_zstd_dictionary_size" in args else 0,
+        )
+
+        cache = None
         if "redis_enable" in args and \
                 args['redis_enable']:
-            redis = Cache(args['redis_uri'], args['redis_ttl'])
-
-        proxy_list = None
+            cache = Cache(
+                args['redis_uri'],
+                args['redis_ttl'],
+                args['redis_max_connections'] if "redis_max_connections" in args else 16,
+                args['redis_circuit_breaker_backoff'] if "redis_circuit_breaker_backoff" in args else 1,
+                compression,
+            )
+        elif "sqlite_enable" in args and \
+                args['sqlite_enable']:
+            cache = SqliteCache(
+                args['sqlite_path'],
+                args['sqlite_ttl'],
+                args['sqlite_max_bytes'],
+                args['sqlite_compaction_interval'] if "sqlite_compaction_interval" in args else 300,
+                compression=compression,
+            )
+        self.cache = cache
+
+        memory_cache = None
+        if "memory_cache_enable" in args and \
+                args['memory_cache_enable']:
+            memory_cache_ttl = args['memory_cache_ttl']
+            if cache is not None:
+                # Never serve from memory what the cache would have expired
+                memory_cache_ttl = min(memory_cache_ttl, cache.ttl)
+            memory_cache = MemoryCache(args['memory_cache_max_bytes'],
+                                       memory_cache_ttl)
+
+        proxies = None
         if "youtube_dl_proxy_list" in args and args['youtube_dl_proxy_list'] is not None and \
                 args['youtube_dl_proxy_list'] != "":
-            proxy_list = args['youtube_dl_proxy_list'].split(',')
+            proxies = ProxyManager(
+                args['youtube_dl_proxy_list'].split(','),
+                args['youtube_dl_proxy_quarantine'] if "youtube_dl_proxy_quarantine" in args else 30,
+            )
+
+        max_workers = args['youtube_dl_max_workers'] if "youtube_dl_max_workers" in args else 1
+        max_queue = args['youtube_dl_max_queue'] if "youtube_dl_max_queue" in args else 64
+
+        limiter = None
+        if "youtube_dl_site_limits" in args and args['youtube_dl_site_limits']:
+            limiter = SiteLimiter(
+                # Shared by every server process
+                parse_limits(args['youtube_dl_site_limits'],
+                             args['grpc_processes'] if "grpc_processes" in args else 1),
+                max_queue,
+            )
+
+        hedging = None
+        if "youtube_dl_hedge_percentile" in args and args['youtube_dl_hedge_percentile'] > 0:
+            hedging = Hedging(
+                args['youtube_dl_hedge_percentile'],
+                args['youtube_dl_hedge_budget'] if "youtube_dl_hedge_budget" in args else 0.05,
+            )
 
         configure_youtube_dl_server(
             base_youtube_dl_args,
-            ProcessPoolExecutor(
-                max_workers=args['youtube_dl_max_workers'] if "youtube_dl_max_workers" in args else 1
+            RecyclingProcessPool(
+                max_workers=max_workers,
+                max_tasks=args['youtube_dl_worker_max_tasks'] if "youtube_dl_worker_max_tasks" in args else 0,
+                max_rss=args['youtube_dl_worker_max_rss'] if "youtube_dl_worker_max_rss" in args else 0,
+                max_age=args['youtube_dl_worker_max_age'] if "youtube_dl_worker_max_age" in args else 0,
+                initializer=init_youtube_dl_worker,
+                initargs=(
+                    args['youtube_dl_instance_cache_size'] if "youtube_dl_instance_cache_size" in args else 0,
+                    # Not an option, only meant for benchmarks
+                    args['youtube_dl_class'] if "youtube_dl_class" in args else None,
+                    base_youtube_dl_args,
+                ),
             ),
-            redis,
-            proxy_list
+            cache,
+            proxies,
+            memory_cache,
+            args['cache_refresh_window'] if "cache_refresh_window" in args else 0,
+            AdmissionQueue(max_workers, max_queue),
+            args['cache_negative_ttl'] if "cache_negative_ttl" in args else 0,
+            limiter,
+            hedging,
+            args['grpc_call_concurrency'] if "grpc_call_concurrency" in args else 16,
         )
 
         self.grpc_graceful_shutdown_timeout = \
             args['grpc_graceful_shutdown_timeout'] if "grpc_graceful_shutdown_timeout" in args else 0
 
+        options = []
+        if "grpc_processes" in args and args['grpc_processes'] > 1:
+            # Other server processes listen on the same port
+            options.append(('grpc.so_reuseport', 1))
+
         self.server = grpc.aio.server(
             compression=self.compression_algorithms[
                 args['grpc_compression_algorithm'] if "grpc_compression_algorithm" in args else "none"
-            ]
+            ],
+            options=options,
         )
 
-        AddYoutubeDLServer(YoutubeDLServer(), self.server)
+        self.warmer = None
+        if "warmer_enable" in args and args['warmer_enable'] and \
+                cache is None and memory_cache is None:
+            log.warning("no cache to keep warm, the cache warmer is disabled")
+        elif "warmer_enable" in args and args['warmer_enable']:
+            self.warmer = Warmer(
+                args['warmer_concurrency'] if "warmer_concurrency" in args else 1,
+                args['warmer_interval'] if "warmer_interval" in args else 3600,
+                args['warmer_lead'] if "warmer_lead" in args else 120,
+            )
+            if "warmer_file" in args and args['warmer_file'] is not None and \
+                    args['warmer_file'] != "":
+                self.warmer.watch(load_requests(args['warmer_file']))
+
+        self.servicer = YoutubeDLServer(self.warmer)
+        AddYoutubeDLServer(self.servicer, self.server)
+
+        self.health = HealthMonitor(
+            self.server,
+            [DESCRIPTOR.services_by_name['YoutubeDL'].full_name],
+            youtube_dl_server_serving,
+            args['grpc_health_interval'] if "grpc_health_interval" in args else 1,
+        )
 
         if "grpc_no_reflection" in args and not args['grpc_no_reflection']:
             # pylint: disable=import-outside-toplevel
+            from grpc_health.v1 import health
             from grpc_reflection.v1alpha import reflection
 
-            from .protobuf.youtube_dl_tiny_grpc_pb2 import \
-                DESCRIPTOR
             reflection.enable_server_reflection((
                 DESCRIPTOR.services_by_name['YoutubeDL'].full_name,
+                health.SERVICE_NAME,
                 reflection.SERVICE_NAME,
             ), self.server)
 
@@ -104,16 +213,29 @@ class Server:
     async def shutdown(self) -> None:
         """ Shutdown the server """
         self._exit_gracefully(None, None)
+        log.info("reporting as not serving")
+        await self.health.stop()
+        if self.warmer is not None:
+            log.info("stopping cache warmer")
+            self.warmer.stop()
         log.info("stopping server")
         await self.server.stop(self.grpc_graceful_shutdown_timeout)
         log.info("stopping youtube_dl process pool")
         shutdown_youtube_dl_server()
+        if self.cache is not None:
+            log.info("flushing cache")
+            await self.cache.close()
         log.info("waiting for server to stop")
         await self.server.wait_for_termination(self.grpc_graceful_shutdown_timeout)
 
     async def run(self) -> None:
         """ Run the server """
+        log.info("warming up youtube_dl process pool")
+        await warm_up_youtube_dl_server()
         await self.server.start()
+        self.health.start()
+        if self.warmer is not None:
+            self.warmer.start(self.servicer.warm)
 
         log.info("server started")
         # Sleep until we get SIGINT or SIGTERM...etc